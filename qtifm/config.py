@@ -5,6 +5,7 @@
 #
 
 import json
+import os
 import platform
 import subprocess
 import sys
@@ -14,6 +15,13 @@ import traceback
 from pathlib import Path
 
 
+def cache_path():
+    cache = os.environ.get('XDG_CACHE_HOME', '')
+    if len(cache) == 0:
+        return Path.home().joinpath('.cache', 'qtifm')
+    return Path(cache).joinpath('qtifm')
+
+
 class Config:
 
     def __init__(self):
@@ -26,12 +34,23 @@ class Config:
         self.editor_recent_files = []
         self.editor_last_file = None
         self.editor_dark_theme = False
+        self.editor_project_root = ''
 
         self.map_ifm_command = 'ifm'
         self.map_ifm_create_image_per_map = True
         self.map_ifm_helvetica_as_default = False
         self.map_fig2dev_command = 'fig2dev'
         self.map_fig2dev_magnification_factor = 3
+        self.map_process_timeout = 120
+        self.map_process_cpu_limit = 120
+        self.map_process_memory_limit = 2048
+        self.map_use_render_daemon = True
+        self.map_dark_mode = False
+        self.map_preview_format = 'png'
+        self.map_prefetch_recent_files = True
+
+        self.watchdog_enabled = False
+        self.watchdog_threshold = 200
 
     def load(self):
         configfile = Path.home().joinpath('.qtifm')
@@ -69,6 +88,7 @@ class Config:
                     self.editor_last_file = file
 
             self.editor_dark_theme = editor.get('dark-theme', self.editor_dark_theme)
+            self.editor_project_root = editor.get('project-root', self.editor_project_root)
 
         map_prop = data.get('map', None)
         if map_prop is not None:
@@ -80,8 +100,20 @@ class Config:
             self.map_fig2dev_command = map_prop.get('fig2dev-command', self.map_fig2dev_command)
             self.map_fig2dev_magnification_factor = map_prop.get('fig2dev-magnification-factor',
                                                                  self.map_fig2dev_magnification_factor)
+            self.map_process_timeout = map_prop.get('process-timeout', self.map_process_timeout)
+            self.map_process_cpu_limit = map_prop.get('process-cpu-limit', self.map_process_cpu_limit)
+            self.map_process_memory_limit = map_prop.get('process-memory-limit', self.map_process_memory_limit)
+            self.map_use_render_daemon = map_prop.get('use-render-daemon', self.map_use_render_daemon)
+            self.map_dark_mode = map_prop.get('dark-mode', self.map_dark_mode)
+            self.map_preview_format = map_prop.get('preview-format', self.map_preview_format)
+            self.map_prefetch_recent_files = map_prop.get('prefetch-recent-files', self.map_prefetch_recent_files)
 
 
+        watchdog = data.get('watchdog', None)
+        if watchdog is not None:
+            self.watchdog_enabled = watchdog.get('enabled', self.watchdog_enabled)
+            self.watchdog_threshold = watchdog.get('threshold', self.watchdog_threshold)
+
     def save(self):
         mainwin = {
             'witdh': self.mainwindow_witdh,
@@ -101,7 +133,8 @@ class Config:
         editor = {
             'recent-files': str_files,
             'last-file': lastfile,
-            'dark-theme': self.editor_dark_theme
+            'dark-theme': self.editor_dark_theme,
+            'project-root': self.editor_project_root,
         }
 
         map_prop = {
@@ -110,12 +143,25 @@ class Config:
             'ifm-helvetica-as-default': self.map_ifm_helvetica_as_default,
             'fig2dev-command': self.map_fig2dev_command,
             'fig2dev-magnification-factor': self.map_fig2dev_magnification_factor,
+            'process-timeout': self.map_process_timeout,
+            'process-cpu-limit': self.map_process_cpu_limit,
+            'process-memory-limit': self.map_process_memory_limit,
+            'use-render-daemon': self.map_use_render_daemon,
+            'dark-mode': self.map_dark_mode,
+            'preview-format': self.map_preview_format,
+            'prefetch-recent-files': self.map_prefetch_recent_files,
+        }
+
+        watchdog = {
+            'enabled': self.watchdog_enabled,
+            'threshold': self.watchdog_threshold,
         }
 
         data = {
             'mainwindow': mainwin,
             'editor': editor,
             'map': map_prop,
+            'watchdog': watchdog,
         }
 
         configfile = Path.home().joinpath('.qtifm')
@@ -6,3 +6,6 @@
 
 VERSION = '1.1'
 RECENT_FILES_COUNT = 10
+JOURNAL_INTERVAL = 5000  # ms
+PREFETCH_IDLE_DELAY = 3000  # ms
+PARSE_DELAY = 300  # ms
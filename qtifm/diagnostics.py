@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Errors and warnings about the IFM source
+#
+
+import re
+
+SEVERITY_ERROR = 'error'
+SEVERITY_WARNING = 'warning'
+
+LINE_PATTERN = re.compile(r'\bline (\d+)')
+
+
+class Diagnostic:
+    __slots__ = ('line', 'column', 'severity', 'message')
+
+    def __init__(self, line, severity, message, column=None):
+        self.line = line
+        self.column = column
+        self.severity = severity
+        self.message = message
+
+
+def parse_ifm_output(output):
+    # ifm reports problems as e.g. "ifm: error: game.ifm, line 12: syntax error", lines without
+    # a line number (like the summary at the end) are skipped
+    result = []
+    for text in output.split('\n'):
+        match = LINE_PATTERN.search(text)
+        if match is None:
+            continue
+        severity = SEVERITY_WARNING if 'warning' in text.lower() else SEVERITY_ERROR
+        message = text[4:].strip() if text.startswith('ifm:') else text.strip()
+        result.append(Diagnostic(int(match.group(1)), severity, message))
+    return result
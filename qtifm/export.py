@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Batch export of the map sections
+#
+
+import os
+import tempfile
+
+from pathlib import Path
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+from render import RenderOptions
+
+# fig2dev output language and extra options per export format
+EXPORT_FORMATS = [
+    ('PNG', 'png', ['-S', '4', '-b', '5']),
+    ('SVG', 'svg', []),
+    ('PDF', 'pdf', []),
+    ('EPS', 'eps', []),
+]
+
+
+class ExportSignals(QObject):
+    finished = pyqtSignal(str, str)  # section name, error output (empty on success)
+
+
+class ExportBatch:
+    # The settings shared by the jobs of one export run. Cancelling kills the running processes.
+
+    def __init__(self, config, file, directory, language, options, magnification_factor):
+        self.render_options = RenderOptions.from_config(config)
+        self.render_options.magnification_factor = magnification_factor
+        self.file = file
+        self.directory = directory
+        self.language = language
+        self.options = options
+        self.temp_dir = tempfile.TemporaryDirectory(prefix='qtifm_export_')
+        self.runner = self.render_options.runner()
+
+    @property
+    def cancelled(self):
+        return self.runner.cancelled
+
+    def target(self, section):
+        if section is None:
+            return self.directory.joinpath(self.file.stem + '.' + self.language)
+        return self.directory.joinpath(self.file.stem + '_' + section + '.' + self.language)
+
+    def cancel(self):
+        self.runner.cancel()
+
+    def cleanup(self):
+        self.temp_dir.cleanup()
+
+    def execute(self, argv):
+        result = self.runner.run(argv, cwd=self.file.parent)
+        output = result.output
+        if result.timed_out:
+            output += '\n' + ' '.join(str(arg) for arg in argv) + ': timeout\n'
+        return 0 if result.ok() else max(1, result.returncode), output
+
+
+class ExportJob(QRunnable):
+
+    def __init__(self, batch, section, name):
+        QRunnable.__init__(self)
+        self.batch = batch
+        self.section = section
+        self.name = name
+        self.signals = ExportSignals()
+
+    def run(self):
+        try:
+            error = self.export()
+        except OSError as e:
+            error = str(e)
+        self.signals.finished.emit(self.name, error)
+
+    def export(self):
+        batch = self.batch
+        fig = Path(batch.temp_dir.name).joinpath((self.section or 'map') + '.fig')
+
+        status, output = batch.execute(batch.render_options.ifm_fig_argv(batch.file, self.section, fig))
+        if batch.cancelled:
+            return ''
+        if status != 0:
+            return output
+
+        # fig2dev writes the (possibly huge) output file itself, it's never loaded into memory
+        argv = batch.render_options.fig2dev_argv(batch.language, batch.options, fig, batch.target(self.section))
+        status, output = batch.execute(argv)
+        if batch.cancelled:
+            return ''
+        if status != 0:
+            return output
+        os.remove(str(fig))
+        return ''
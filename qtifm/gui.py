@@ -5,22 +5,37 @@
 #
 
 import constants as const
+import diagnostics
+import export
+import ifmparser
+import mapimage
+import mapindex
+import mapmodel
+import prefetch
+import projectindex
+import render
+import storage
+import tasks
+import transcript
+import watchdog
 from config import Config
 
 import gettext
 import os
-import subprocess
 import sys
 import traceback
 
 from pathlib import Path
 from PyQt5.QtGui import (QColor, QIcon, QPalette, QPixmap, QSyntaxHighlighter, QTextCursor, QTextCharFormat,
-                         QTextOption, QImage, QTextDocument)
-from PyQt5.QtCore import pyqtSlot, Qt,  QRegExp, pyqtSignal
+                         QTextOption, QTextDocument, QPainter, QPen, QTextBlock)
+from PyQt5.QtCore import pyqtSlot, Qt,  QRegExp, pyqtSignal, QRectF, QThreadPool, QTimer, QPoint, QRect, QEvent, QSize
 from PyQt5.QtWidgets import (QAction, QCheckBox, QDialog, QFileDialog, QHBoxLayout, QLabel,
                              QMainWindow, QPlainTextEdit, QPushButton, QSizePolicy,
                              QSplitter, QVBoxLayout, QWidget, QDialogButtonBox, QGridLayout, QLineEdit,
-                             QMessageBox, QScrollArea, QTextEdit, QTabWidget, QSpinBox, QLayout)
+                             QMessageBox, QScrollArea, QTextEdit, QTabWidget, QSpinBox, QLayout,
+                             QComboBox, QListWidget, QListWidgetItem, QProgressBar, QApplication, QDockWidget,
+                             QProgressDialog,
+                             QTreeWidget, QTreeWidgetItem, QToolTip)
 
 images_path = Path(__file__).parent.joinpath('images')
 resources_path = Path(__file__).parent.joinpath('resources')
@@ -82,6 +97,36 @@ class AboutDialog(QDialog):
         self.resize(600, 400)
 
 
+class StallReportDialog(QDialog):
+
+    def __init__(self, stall_watchdog, *args):
+        QDialog.__init__(self, *args)
+        self.setWindowTitle(_('GUI Stalls'))
+
+        dlglyt = QVBoxLayout()
+        self.setLayout(dlglyt)
+
+        if stall_watchdog is None:
+            text = _('The stall watchdog is disabled. It can be enabled in the settings.')
+        else:
+            text = _('Stalls of the user interface in this session:') + '\n\n' + stall_watchdog.summary() + \
+                   '\n\n' + _('Log file:') + ' ' + str(watchdog.stall_log_path())
+
+        textedit = QPlainTextEdit(self)
+        textedit.setPlainText(text)
+        textedit.moveCursor(QTextCursor.Start)
+        textedit.setTextInteractionFlags(Qt.TextSelectableByKeyboard | Qt.TextSelectableByMouse)
+        textedit.setSizePolicy(QSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding))
+        textedit.setStyleSheet('font: 9pt "Monospace"')
+        dlglyt.addWidget(textedit)
+
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok)
+        button_box.accepted.connect(self.accept)
+        dlglyt.addWidget(button_box)
+
+        self.resize(700, 500)
+
+
 class Highlighter(QSyntaxHighlighter):
 
     def __init__(self, dark_theme, parent=None):
@@ -120,9 +165,36 @@ class Highlighter(QSyntaxHighlighter):
         self.setCurrentBlockState(0)
 
 
+class LineNumberArea(QWidget):
+
+    def __init__(self, editor):
+        QWidget.__init__(self, editor)
+        self.editor = editor
+
+    def sizeHint(self):
+        return self.editor.line_number_area_size()
+
+    def paintEvent(self, event):
+        self.editor.paint_line_numbers(event)
+
+    def event(self, event):
+        if event.type() == QEvent.ToolTip:
+            messages = self.editor.diagnostic_messages(event.pos().y())
+            if len(messages) > 0:
+                QToolTip.showText(event.globalPos(), '\n'.join(messages), self)
+            else:
+                QToolTip.hideText()
+                event.ignore()
+            return True
+        return QWidget.event(self, event)
+
+
 class Editor(QTextEdit):
     map_changed_signal = pyqtSignal(Path)
     map_cleared_signal = pyqtSignal()
+    cursor_line_changed_signal = pyqtSignal(int)
+    file_loaded_signal = pyqtSignal()
+    recover_journals = True  # offer to restore the edits of journals left by a crash
 
     def __init__(self, mainwin, dark_theme, *args):
         QTextEdit.__init__(self, *args)
@@ -134,11 +206,24 @@ class Editor(QTextEdit):
         self.setWordWrapMode(QTextOption.NoWrap)
         self.setTabStopWidth(int(self.tabStopWidth() / 2))
 
+        # line numbers and diagnostics, only the visible blocks are painted
+        self.diagnostic_marks = []  # (cursor, entries), the cursors move along with edits
+        self.render_diagnostics = []
+        self.parse_diagnostics = []
+        self.top_block = QTextBlock()
+        self.line_number_area = LineNumberArea(self)
+        self.document().blockCountChanged.connect(self.update_line_number_area_width)
+        self.verticalScrollBar().valueChanged.connect(self.line_number_area.update)
+        self.textChanged.connect(self.line_number_area.update)
+        self.cursorPositionChanged.connect(self.line_number_area.update)
+        self.update_line_number_area_width()
+
         self.current_file = None
         self.current_file_name = ''
         self.saveable = False
 
         # cursor position handling
+        self.cursor_line = 0
         self.cursor_position_label = QLabel()
         self.cursor_position_label.setSizePolicy(QSizePolicy(QSizePolicy.Minimum, QSizePolicy.Minimum))
         self.cursorPositionChanged.connect(self.cursor_position_changed)
@@ -151,8 +236,174 @@ class Editor(QTextEdit):
         self.editor_modified_label.setSizePolicy(QSizePolicy(QSizePolicy.Minimum, QSizePolicy.Minimum))
         self.textChanged.connect(self.text_changed)
 
+        # saving in the background, one file at a time
+        self.save_pool = QThreadPool(self)
+        self.save_pool.setMaxThreadCount(1)
+
+        self.import_job = None
+
+        # the syntax is checked on a worker thread shortly after typing
+        self.map_sections_label = QLabel()
+        self.map_sections_label.setSizePolicy(QSizePolicy(QSizePolicy.Minimum, QSizePolicy.Minimum))
+        self.parse_pool = QThreadPool(self)
+        self.parse_pool.setMaxThreadCount(1)
+        self.parse_tokenizer = ifmparser.Tokenizer()  # only used on the parse thread
+        self.parse_result = None
+        self.parse_revision = -1
+        self.saved_revision = -1  # the revision of the text last saved or opened
+        self.parse_timer = QTimer(self)
+        self.parse_timer.setSingleShot(True)
+        self.parse_timer.setInterval(const.PARSE_DELAY)
+        self.parse_timer.timeout.connect(self.parse)
+        self.textChanged.connect(self.parse_timer.start)
+
+        # crash recovery
+        self.journal = storage.RecoveryJournal()
+        self.document().contentsChange.connect(self.contents_change)
+        self.journal_timer = QTimer(self)
+        self.journal_timer.timeout.connect(self.journal.flush)
+        self.journal_timer.start(const.JOURNAL_INTERVAL)
+
         self.update_state()
 
+    def line_number_area_size(self):
+        digits = len(str(max(1, self.document().blockCount())))
+        width = 8 + self.fontMetrics().width('9') * digits + self.fontMetrics().height()
+        return QSize(width, 0)
+
+    @pyqtSlot()
+    def update_line_number_area_width(self):
+        width = self.line_number_area_size().width()
+        if width != self.viewportMargins().left():
+            self.setViewportMargins(width, 0, 0, 0)
+
+    def resizeEvent(self, event):
+        QTextEdit.resizeEvent(self, event)
+        rect = self.contentsRect()
+        self.line_number_area.setGeometry(QRect(rect.left(), rect.top(), self.viewportMargins().left(),
+                                                rect.height()))
+
+    def visible_blocks(self, top, bottom):
+        # yields (block, y, height) in viewport coordinates, starting with the first visible block
+        layout = self.document().documentLayout()
+        offset = self.verticalScrollBar().value()
+        block = self.first_visible_block(layout, offset + top)
+        while block.isValid():
+            rect = layout.blockBoundingRect(block)
+            y = rect.top() - offset
+            if y > bottom:
+                break
+            if block.isVisible():
+                yield block, y, rect.height()
+            block = block.next()
+
+    def first_visible_block(self, layout, y):
+        # the hit test of the layout is expensive in long documents, so the search starts at the block
+        # found last time and only falls back to the hit test after a long jump
+        block = self.top_block
+        if not block.isValid() or abs(layout.blockBoundingRect(block).top() - y) > 4 * self.viewport().height():
+            block = self.cursorForPosition(QPoint(0, max(0, y - self.verticalScrollBar().value()))).block()
+        while block.previous().isValid() and layout.blockBoundingRect(block).top() > y:
+            block = block.previous()
+        while block.next().isValid():
+            rect = layout.blockBoundingRect(block)
+            if rect.height() == 0 or rect.bottom() > y:
+                break  # blocks without height are not laid out yet
+            block = block.next()
+        self.top_block = block
+        return block
+
+    def paint_line_numbers(self, event):
+        painter = QPainter(self.line_number_area)
+        palette = self.line_number_area.palette()
+        painter.fillRect(event.rect(), palette.color(QPalette.Window))
+        width = self.line_number_area.width()
+        marker = self.fontMetrics().height()
+        current = self.textCursor().blockNumber()
+        marks = self.marked_blocks()
+
+        for block, y, height in self.visible_blocks(event.rect().top(), event.rect().bottom()):
+            line = block.blockNumber() + 1
+            entries = marks.get(block.blockNumber())
+            if entries is not None:
+                error = any(d.severity == diagnostics.SEVERITY_ERROR for d in entries)
+                painter.setPen(Qt.NoPen)
+                painter.setBrush(QColor(220, 40, 40) if error else QColor(230, 160, 0))
+                size = int(marker * 0.6)
+                painter.drawEllipse(int((marker - size) / 2), int(y + (marker - size) / 2), size, size)
+
+            color = palette.color(QPalette.WindowText)
+            if line - 1 != current:
+                color.setAlpha(140)
+            painter.setPen(color)
+            painter.drawText(0, int(y), width - 4, int(height), Qt.AlignRight | Qt.AlignTop, str(line))
+        painter.end()
+
+    def diagnostic_messages(self, y):
+        for block, top, height in self.visible_blocks(y, y):
+            if top <= y < top + height:
+                return [d.message for d in self.marked_blocks().get(block.blockNumber(), [])]
+        return []
+
+    def marked_blocks(self):
+        # the diagnostics by the number of the block they are in now
+        marks = {}
+        for cursor, entries in self.diagnostic_marks:
+            marks.setdefault(cursor.block().blockNumber(), []).extend(entries)
+        return marks
+
+    @pyqtSlot()
+    def parse(self):
+        revision = self.document().revision()
+        tasks.start_task(ifmparser.parse, self.toPlainText(), self.parse_tokenizer, pool=self.parse_pool,
+                         finished=lambda result: self.parsed(revision, result))
+
+    def parsed(self, revision, result):
+        if revision != self.document().revision():
+            return  # the text has changed since, another parse follows
+        self.parse_result = result
+        self.parse_revision = revision
+        self.map_sections_label.setText(_('Map sections: ') + str(result.sections))
+        self.parse_diagnostics = result.diagnostics
+        self.show_diagnostics()
+
+    def saved_syntax(self, file):
+        # the parse result of the file as saved, None if it isn't parsed yet
+        if file == self.current_file and self.parse_revision == self.saved_revision:
+            return self.parse_result
+        return None
+
+    @pyqtSlot(list)
+    def set_diagnostics(self, entries):
+        # the messages of ifm, for the saved file
+        self.render_diagnostics = entries
+        self.show_diagnostics()
+
+    def show_diagnostics(self):
+        lines = {}
+        for entry in self.parse_diagnostics + self.render_diagnostics:
+            lines.setdefault(entry.line, []).append(entry)
+
+        # squiggles under the offending lines, the gutter markers follow their cursors
+        selections = []
+        self.diagnostic_marks = []
+        for line, entries in lines.items():
+            block = self.document().findBlockByNumber(line - 1)
+            if not block.isValid():
+                continue
+            error = any(d.severity == diagnostics.SEVERITY_ERROR for d in entries)
+            selection = QTextEdit.ExtraSelection()
+            selection.format.setUnderlineStyle(QTextCharFormat.SpellCheckUnderline)
+            selection.format.setUnderlineColor(QColor(220, 40, 40) if error else QColor(230, 160, 0))
+            selection.cursor = QTextCursor(block)
+            column = min(entry.column for entry in entries) if all(e.column for e in entries) else 1
+            selection.cursor.setPosition(block.position() + min(column - 1, max(0, block.length() - 1)))
+            selection.cursor.setPosition(block.position() + max(0, block.length() - 1), QTextCursor.KeepAnchor)
+            selections.append(selection)
+            self.diagnostic_marks.append((QTextCursor(selection.cursor), entries))
+        self.setExtraSelections(selections)
+        self.line_number_area.update()
+
     def reset_highlighter(self, dark_theme):
         self.highlighter = Highlighter(dark_theme, self.document())
 
@@ -163,6 +414,21 @@ class Editor(QTextEdit):
             _('Line:') + ' ' + str(cursor.blockNumber() + 1) + ', ' + _('Column:') + ' ' + str(
                 cursor.columnNumber() + 1))
 
+        line = cursor.blockNumber() + 1
+        if line != self.cursor_line:
+            self.cursor_line = line
+            self.cursor_line_changed_signal.emit(line)
+
+    @pyqtSlot(int)
+    def goto_line(self, line):
+        block = self.document().findBlockByLineNumber(line - 1)
+        if block.isValid():
+            cursor = self.textCursor()
+            cursor.setPosition(block.position())
+            self.setTextCursor(cursor)
+            self.ensureCursorVisible()
+            self.setFocus()
+
     @pyqtSlot()
     def text_changed(self):
         if self.editor_init:
@@ -173,6 +439,42 @@ class Editor(QTextEdit):
             self.editor_modified = True
             self.editor_modified_label.setText(_('Modified  /'))
 
+    @pyqtSlot(int, int, int)
+    def contents_change(self, position, removed, added):
+        if self.journal.active:
+            self.journal.record(position, removed, self.inserted_text(position, added))
+
+    def inserted_text(self, position, added):
+        if added == 0:
+            return ''
+        cursor = QTextCursor(self.document())
+        cursor.setPosition(position)
+        cursor.movePosition(QTextCursor.NextCharacter, QTextCursor.KeepAnchor, added)
+        return cursor.selectedText().replace('\u2029', '\n')
+
+    def start_journal(self, file, text, recover=True):
+        base = storage.text_hash(text)
+        ops = self.journal.start(file, base, recover=recover and self.recover_journals)
+        if ops is None:
+            return
+
+        choice = QMessageBox.question(self.main_window, _('Recover'),
+                                      _('There are unsaved changes from a previous session. Restore them?'),
+                                      QMessageBox.Yes | QMessageBox.No)
+        if choice == QMessageBox.Yes:
+            self.replay_journal(ops)
+
+    def replay_journal(self, ops):
+        self.editor_init = False
+        cursor = QTextCursor(self.document())
+        cursor.beginEditBlock()
+        for position, removed, text in ops:
+            end = self.document().characterCount() - 1
+            cursor.setPosition(min(position, end))
+            cursor.setPosition(min(position + removed, end), QTextCursor.KeepAnchor)
+            cursor.insertText(text)
+        cursor.endEditBlock()
+
     def abort_if_modified(self, title):
         if self.editor_modified:
             choice = QMessageBox.question(self.main_window, title,
@@ -199,19 +501,24 @@ class Editor(QTextEdit):
             return
 
         if path is not None and path.exists():
+            self.journal.discard()
             self.editor_init = True
             self.clear()
             self.current_file = None
             try:
                 with open(path, 'r', encoding='utf-8') as file:
+                    text = file.read()
                     self.editor_init = True
-                    self.insertPlainText(file.read())
+                    self.insertPlainText(text)
                     self.setFocus()
                     cursor = self.textCursor()
                     cursor.setPosition(0)
                     self.setTextCursor(cursor)
                     self.current_file = path
 
+                self.saved_revision = self.document().revision()
+                self.file_loaded_signal.emit()  # before the recovered edits, they are edits of the file
+                self.start_journal(path, text)
                 self.map_changed_signal.emit(self.current_file)  # don't do this within the "with" statement
 
             except OSError:
@@ -267,21 +574,37 @@ class Editor(QTextEdit):
     @pyqtSlot()
     def save_file(self, update=False):
         if self.current_file is not None:
-            try:
-                with open(self.current_file, 'w', encoding='utf-8') as file:
-                    file.write(self.toPlainText())
-                    self.editor_init = True
-                    self.text_changed()
-                    if update:
-                        self.update_state(self.current_file)
+            # the file is written from a snapshot on the save thread
+            file = self.current_file
+            text = self.toPlainText()
+            mark = self.journal.mark()
+            revision = self.document().revision()
+            tasks.start_task(storage.write_atomic, file, text, pool=self.save_pool,
+                             finished=lambda base: self.file_saved(file, base, mark, revision, update),
+                             failed=lambda error: self.save_failed(file))
+
+    def file_saved(self, file, base, mark, revision, update):
+        if file != self.current_file:
+            return  # another file was opened in the meantime, the journal and state belong to it
+        self.journal.saved(file, base, mark)
+        self.saved_revision = revision
+        if self.document().revision() == revision:
+            self.editor_init = True
+            self.text_changed()
+        if update:
+            self.update_state(file)
 
-                self.map_changed_signal.emit(self.current_file)  # don't do this within the "with" statement
-            except OSError:
-                sys.stderr.write('Could not save IFM file: \'' + str(self.current_file) + '\'\n')
-                traceback.print_exc(file=sys.stderr)
-                QMessageBox.critical(self, _('Save'), _(
-                    'An error occured while writing the IFM file!\n'
-                    'See console output for details.'), QMessageBox.Ok)
+        self.map_changed_signal.emit(file)
+
+    def save_failed(self, file):
+        sys.stderr.write('Could not save IFM file: \'' + str(file) + '\'\n')
+        QMessageBox.critical(self, _('Save'), _(
+            'An error occured while writing the IFM file!\n'
+            'See console output for details.'), QMessageBox.Ok)
+
+    def wait_for_save(self):
+        self.save_pool.waitForDone()
+        QApplication.processEvents()
 
     @pyqtSlot()
     def save_file_as(self):
@@ -293,16 +616,118 @@ class Editor(QTextEdit):
             self.save_file(update=True)
 
     @pyqtSlot()
-    def new_file(self):
-        if self.abort_if_modified(_('New')):
+    def new_file(self, check_modified=True):
+        if check_modified and self.abort_if_modified(_('New')):
             return
 
+        self.journal.discard()
         self.editor_init = True
         self.clear()
         self.current_file = None
+        self.start_journal(None, '', recover=False)
         self.update_state()
+        self.file_loaded_signal.emit()
         self.map_cleared_signal.emit()
 
+    @pyqtSlot()
+    def import_transcript(self):
+        if self.abort_if_modified(_('Import Transcript')):
+            return
+
+        filename, ignore = QFileDialog.getOpenFileName(self.main_window, _('Import Transcript'), '',
+                                                       options=QFileDialog.DontUseNativeDialog,
+                                                       filter='Transcripts (*.txt *.scr *.log);;All files (*)')
+        if filename:
+            self.import_path(Path(filename))
+
+    def import_path(self, path):
+        # the transcript is read on a worker thread, the IFM source is appended to a new buffer in chunks
+        self.new_file(check_modified=False)
+        progress = QProgressDialog(_('Importing the transcript...'), _('Cancel'), 0, 100, self.main_window)
+        progress.setWindowTitle(_('Import Transcript'))
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(500)
+
+        job = transcript.ImportJob(path, path.stem)
+        job.signals.chunk.connect(self.append_import_chunk)
+        job.signals.progress.connect(progress.setValue)
+        job.signals.finished.connect(lambda error: self.import_finished(path, error, progress))
+        progress.canceled.connect(job.cancel)
+        self.import_job = job
+        tasks.task_pool().start(job)
+
+    def append_import_chunk(self, text):
+        cursor = QTextCursor(self.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
+        if self.import_job is not None:
+            self.import_job.chunk_done()
+
+    def import_finished(self, path, error, progress):
+        progress.reset()
+        self.import_job = None
+        if len(error) > 0:
+            sys.stderr.write('Could not read the transcript: \'' + str(path) + '\': ' + error + '\n')
+            QMessageBox.critical(self, _('Import Transcript'), _(
+                'An error occured while reading the transcript!\n'
+                'See console output for details.'), QMessageBox.Ok)
+
+
+DECODE_SCALES = [0.25, 0.5]
+
+
+class MapLabel(QLabel):
+    room_clicked_signal = pyqtSignal(object)
+
+    def __init__(self, *args):
+        QLabel.__init__(self, *args)
+        self.geometry_data = None
+        self.highlighted_room = None
+        self.image_size = None  # the full size, the pixmap may be decoded smaller
+        self.changes = None  # the regions changed since the previous render, in image pixels
+        self.show_changes = False
+
+    def image_scale(self):
+        if self.image_size is None or self.image_size.width() == 0:
+            return 1.0
+        return self.width() / self.image_size.width()
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton and self.geometry_data is not None:
+            scale = self.image_scale()
+            room = self.geometry_data.hit_test(event.pos().x() / scale, event.pos().y() / scale)
+            if room is not None:
+                self.room_clicked_signal.emit(room)
+                return
+        QLabel.mousePressEvent(self, event)
+
+    def paintEvent(self, event):
+        QLabel.paintEvent(self, event)
+        if self.show_changes and self.changes:
+            scale = self.image_scale()
+            painter = QPainter(self)
+            pen = QPen(QColor(220, 40, 40))
+            pen.setWidth(2)
+            painter.setPen(pen)
+            painter.setBrush(QColor(220, 40, 40, 50))
+            for x1, y1, x2, y2 in self.changes:
+                painter.drawRect(QRectF(x1 * scale, y1 * scale, (x2 - x1) * scale, (y2 - y1) * scale))
+            painter.end()
+        if self.highlighted_room is not None and self.geometry_data is not None:
+            rect = self.room_rect(self.highlighted_room)
+            painter = QPainter(self)
+            pen = QPen(QColor(255, 120, 0))
+            pen.setWidth(3)
+            painter.setPen(pen)
+            painter.drawRect(QRectF(rect.x1, rect.y1, rect.width(), rect.height()).adjusted(-3, -3, 3, 3))
+            painter.end()
+
+    def room_rect(self, room):
+        # the room rectangle in widget coordinates
+        rect = self.geometry_data.image_rect(room.rect)
+        scale = self.image_scale()
+        return mapindex.Rect(rect.x1 * scale, rect.y1 * scale, rect.x2 * scale, rect.y2 * scale)
+
 
 class ImageViewer(QScrollArea):
 
@@ -311,8 +736,13 @@ class ImageViewer(QScrollArea):
 
         self.changed_signal = changed_signal
         self.scale_factor = 1.0
+        self.image_file = None
+        self.previous_image_file = None
+        self.dark_mode = False
+        self.pixmaps = {}
+        self.comparing = False
 
-        self.image_label = QLabel()
+        self.image_label = MapLabel()
         self.image_label.setBackgroundRole(QPalette.Base)
         self.image_label.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
         self.image_label.setScaledContents(True)
@@ -331,18 +761,99 @@ class ImageViewer(QScrollArea):
         else:
             QScrollArea.wheelEvent(self, event)
 
-    def load_image(self, filename):
-        image = QImage(str(filename))
+    def load_image(self, filename, scale_factor=None):
+        self.image_file = filename
+        self.pixmaps = {}
+        if scale_factor is not None:
+            self.scale_factor = scale_factor
+        self.decode(self.dark_mode)
+
+    def decode_scale(self):
+        # zoomed out images are decoded smaller, in steps to avoid decoding again on every zoom step
+        for scale in DECODE_SCALES:
+            if self.scale_factor <= scale:
+                return scale
+        return 1.0
+
+    def decode(self, dark):
+        # the image is decoded (or computed, for the dark variant) on a worker thread
+        scale = self.decode_scale()
+        function = mapimage.load_dark_image if dark else mapimage.decode_image
+        tasks.start_task(function, self.image_file, scale,
+                         finished=lambda result: self.image_decoded(dark, scale, result))
+
+    def image_decoded(self, dark, scale, result):
+        image, size = result
         if image.isNull():
             return
-
-        self.image_label.setPixmap(QPixmap.fromImage(image))
-        self.scale_factor = 1.0
-        self.image_label.adjustSize()
+        entry = self.pixmaps.get(dark)
+        if entry is not None and entry[1] >= scale:
+            return  # a sharper image arrived first
+
+        self.pixmaps[dark] = (QPixmap.fromImage(image), scale)
+        if self.image_label.image_size is None:
+            self.image_label.image_size = size
+            if self.image_label.geometry_data is not None:
+                self.image_label.geometry_data.set_image_size(size.width(), size.height())
+        if dark == self.dark_mode:
+            self.show_pixmap()
+
+    def set_dark_mode(self, dark_mode):
+        self.dark_mode = dark_mode
+        if self.image_file is None:
+            return
+        entry = self.pixmaps.get(dark_mode)
+        if entry is not None:
+            self.show_pixmap()
+        if entry is None or entry[1] < self.decode_scale():
+            self.decode(dark_mode)
+
+    def set_show_changes(self, show):
+        # the changes against the previous render are computed on a worker thread when first shown
+        self.image_label.show_changes = show
+        self.image_label.update()
+        if show and self.image_label.changes is None and self.previous_image_file is not None \
+                and self.image_file is not None and not self.comparing:
+            self.comparing = True
+            tasks.start_task(mapimage.changed_regions, self.previous_image_file, self.image_file,
+                             finished=self.changes_computed, failed=self.changes_computed)
+
+    def changes_computed(self, regions):
+        self.comparing = False
+        self.image_label.changes = regions if isinstance(regions, list) else []
+        self.image_label.update()
+
+    def show_pixmap(self):
+        entry = self.pixmaps.get(self.dark_mode)
+        if entry is not None:
+            self.image_label.setPixmap(entry[0])
+            self.image_label.resize(self.scale_factor * self.image_label.image_size)
+
+    def set_geometry_data(self, geometry):
+        self.image_label.geometry_data = geometry
+        size = self.image_label.image_size
+        if geometry is not None and size is not None:
+            geometry.set_image_size(size.width(), size.height())
+
+    def highlight_room(self, room):
+        self.image_label.highlighted_room = room
+        self.image_label.update()
+        if room is not None and self.image_label.geometry_data is not None:
+            x, y = self.image_label.room_rect(room).center()
+            self.horizontalScrollBar().setValue(int(x - self.viewport().width() / 2))
+            self.verticalScrollBar().setValue(int(y - self.viewport().height() / 2))
 
     def normal_size(self):
-        self.image_label.adjustSize()
         self.scale_factor = 1.0
+        self.update_size()
+
+    def update_size(self):
+        if self.image_label.image_size is None:
+            return
+        self.image_label.resize(self.scale_factor * self.image_label.image_size)
+        entry = self.pixmaps.get(self.dark_mode)
+        if entry is not None and entry[1] < self.decode_scale():
+            self.decode(self.dark_mode)
 
     def scale_image(self, factor, absolute=False):
         test_factor = self.scale_factor + factor
@@ -355,7 +866,7 @@ class ImageViewer(QScrollArea):
         if absolute:
             self.scale_factor = factor
 
-        self.image_label.resize(self.scale_factor * self.image_label.pixmap().size())
+        self.update_size()
 
         self.adjust_scroll_bar(self.horizontalScrollBar(), factor)
         self.adjust_scroll_bar(self.verticalScrollBar(), factor)
@@ -373,6 +884,11 @@ class ImageViewer(QScrollArea):
 
 class MapView(QTabWidget):
     map_view_changed_signal = pyqtSignal()
+    room_selected_signal = pyqtSignal(int)
+    diagnostics_signal = pyqtSignal(list)
+    render_started_signal = pyqtSignal()
+    render_finished_signal = pyqtSignal()
+    model_changed_signal = pyqtSignal()
 
     def __init__(self, mainwin, config, *args):
         QTabWidget.__init__(self, *args)
@@ -382,6 +898,15 @@ class MapView(QTabWidget):
         self.config = config
         self.valid = False
         self.last_file = None
+        self.source_index = None
+        self.sections = []
+        self.model = None  # the rooms, links and items, read in the background when first used
+        self.model_raw = None  # the raw output of ifm of the current render
+        self.model_loading = None  # the raw output read in the background
+        self.show_changes = False
+        self.last_key = None
+        self.last_images = []  # the images of the last successful render of last_file
+        self.previous_images = []  # the images the changes are shown against
 
         self.zoom_factor_label = QLabel()
         self.zoom_factor_label.setSizePolicy(QSizePolicy(QSizePolicy.Minimum, QSizePolicy.Minimum))
@@ -397,7 +922,11 @@ class MapView(QTabWidget):
     def clear_maps(self):
         self.clear()
         self.valid = False
+        self.source_index = None
+        self.sections = []
+        self.reset_model()
         self.display_message(self, _('Save the file to create the map images.'))
+        self.diagnostics_signal.emit([])
         self.map_view_changed_signal.emit()
 
     @pyqtSlot(Path)
@@ -412,104 +941,172 @@ class MapView(QTabWidget):
 
         self.clear()
         self.valid = False
+        self.source_index = None
+        self.sections = []
+        self.reset_model()
+
+        # files the parser knows to be invalid aren't given to ifm, the editor shows the errors
+        check = self.main_window.editor.saved_syntax(file)
+        if check is not None and not check.valid():
+            self.diagnostics_signal.emit([])
+            self.display_render_error(render.RenderResult(render.RENDER_STATUS_SYNTAX, check.output()))
+            self.map_view_changed_signal.emit()
+            return
 
-        base = file.parent
+        # render the maps, preferably by the render daemon shared with other instances
+        self.render_started_signal.emit()
+        options = render.RenderOptions.from_config(self.config)
+        result = None
+        if self.config.map_use_render_daemon:
+            result = render.RenderClient().render(options, file)
+        if result is None:
+            try:
+                result = render.render_file(options, file)
+            except OSError as e:
+                traceback.print_exc(file=sys.stderr)
+                result = render.RenderResult(render.RENDER_STATUS_IFM, str(e))
+        self.render_finished_signal.emit()
 
-        # check syntax
-        status, output = subprocess.getstatusoutput(self.config.map_ifm_command + ' "' + str(file) + '"')
-        if status != 0:
-            self.display_message(_('The syntax of the map file isn\'t correct!'), error=output)
+        self.diagnostics_signal.emit(diagnostics.parse_ifm_output(result.output))
+        if not result.ok():
+            self.display_render_error(result)
             return
 
-        # check maps
-        self.valid = True
-        sections = []
-
-        if self.config.map_ifm_create_image_per_map:
-            status, output = subprocess.getstatusoutput(
-                self.config.map_ifm_command + ' --show=maps "' + str(file) + '"')
-            if status != 0:
-                self.display_message(_('The syntax of the map file isn\'t correct!'), error=output)
-                return
+        # the changes are shown against the last different render of the same file
+        if file != self.last_file:
+            self.previous_images = []
+        elif result.key is None or result.key != self.last_key:
+            self.previous_images = self.last_images
+        self.last_images = [section.image for section in result.sections]
+        self.last_key = result.key
 
-            if output is not None and len(output) > 0:
-                lines = output.split('\n')
-                length = len(lines)
-                if length > 1:
-                    header = False
-                    for i in range(0, length):
-                        if header:
-                            line = lines[i].split('\t')
-                            if len(line) == 5:
-                                sections.append([line[0], line[4]])
-                        else:
-                            header = lines[i].startswith('No.')
-
-        if len(sections) > 0:
-            for i in range(0, len(sections)):
-                scale_factor = None
-                if i < len(old_viewers):
-                    scale_factor = old_viewers[i].scale_factor
-                section = sections[i]
-                self.create_map_section(file, base, section[0], section[1], scale_factor)
-        else:
-            self.create_map_section(file, base, None, _('Map'), None)
+        self.valid = True
+        magnification = options.magnification()
+        for i in range(0, len(result.sections)):
+            scale_factor = None
+            if i < len(old_viewers):
+                scale_factor = old_viewers[i].scale_factor
+            previous_image = None
+            if i < len(self.previous_images) and self.previous_images[i] != result.sections[i].image:
+                previous_image = self.previous_images[i]
+            self.create_map_section(result.sections[i], magnification, scale_factor, previous_image)
+
+        for section in result.sections:
+            self.sections.append([section.section, section.name if section.name is not None else _('Map')])
 
         if 0 <= selected_index < self.count():
             self.setCurrentIndex(selected_index)
 
+        self.create_source_index(file)
+
         self.last_file = file
         self.map_view_changed_signal.emit()
+        self.reset_model(result.raw)
+
+    def reset_model(self, raw=None):
+        self.model_raw = raw
+        self.set_model(None)
+
+    def load_model(self):
+        # starts reading the model of the current render, model_changed_signal is emitted when it's read
+        raw = self.model_raw
+        if self.model is None and raw is not None and raw != self.model_loading:
+            self.model_loading = raw
+            tasks.start_task(mapmodel.load_model, raw, finished=lambda model: self.model_loaded(raw, model))
+
+    def model_loaded(self, raw, model):
+        if raw == self.model_loading:
+            self.model_loading = None
+        if raw == self.model_raw:
+            if model is None:
+                self.model_raw = None  # unreadable, not tried again
+            self.set_model(model)
+
+    def set_model(self, model):
+        if model is not self.model:
+            self.model = model
+            self.model_changed_signal.emit()
+
+    def room(self, tag):
+        # the room with the tag, None if there is none or the model isn't read yet
+        self.load_model()
+        return self.model.room(tag) if self.model is not None else None
+
+    def section_rooms(self, index):
+        # the rooms shown in the tab with the index, empty while the model isn't read
+        self.load_model()
+        if self.model is None or not 0 <= index < len(self.sections):
+            return []
+        section = self.sections[index][0]
+        if section is None:
+            return self.model.rooms  # all sections in one image
+        return self.model.section_rooms(int(section))
+
+    def create_map_section(self, section, magnification, scale_factor, previous_image=None):
+        # display images
+        viewer = ImageViewer(self.map_view_changed_signal)
+        viewer.set_geometry_data(mapindex.load_geometry(section.fig, magnification))
+        viewer.set_dark_mode(self.config.map_dark_mode)
+        viewer.load_image(section.image, scale_factor)
+        viewer.previous_image_file = previous_image
+        viewer.set_show_changes(self.show_changes)
+        viewer.image_label.room_clicked_signal.connect(self.room_clicked)
+        self.addTab(viewer, section.name if section.name is not None else _('Map'))
+
+    def set_dark_mode(self, dark_mode):
+        if self.valid:
+            for i in range(0, self.count()):
+                self.widget(i).set_dark_mode(dark_mode)
 
-    def create_map_section(self, file, base, section, name, scale_factor):
-        # create fig files
-        style = ''
-        if self.config.map_ifm_helvetica_as_default:
-            style = ' -S helvetica'
-
-        if section is not None:
-            fig = base.joinpath(file.stem + '_qtifm_' + section + '.fig')
+    @pyqtSlot(bool)
+    def set_show_changes(self, show):
+        self.show_changes = show
+        if self.valid:
+            for i in range(0, self.count()):
+                self.widget(i).set_show_changes(show)
+
+    def display_render_error(self, result):
+        if result.status == render.RENDER_STATUS_SYNTAX:
+            message = _('The syntax of the map file isn\'t correct!')
+        elif result.status == render.RENDER_STATUS_FIG2DEV:
+            message = _('An error occurred while running FIG2DEV to create the images!')
+        elif result.status == render.RENDER_STATUS_TIMEOUT:
+            message = _('The process didn\'t finish within the time limit and was stopped!')
+        elif result.status == render.RENDER_STATUS_FAILED:
+            message = _('IFM or FIG2DEV couldn\'t be started or was stopped by a resource limit!')
         else:
-            fig = base.joinpath(file.stem + '_qtifm.fig')
+            message = _('An error occurred while running IFM to create the fig files!')
+        self.display_message(message, error=result.output)
 
-        if section is not None:
-            cmd = self.config.map_ifm_command + style + ' -m=' + section + ' -f fig -o "' + str(fig) + '" "' + \
-                  str(file) + '"'
-        else:
-            cmd = self.config.map_ifm_command + style + ' -m -f fig -o "' + str(fig) + '" "' + str(file) + '"'
-        status, output = subprocess.getstatusoutput(cmd)
-        if status != 0:
-            self.valid = False
-            self.display_message(_('An error occurred while running IFM to create the fig files!'), error=output)
+    def create_source_index(self, file):
+        geometries = []
+        for i in range(0, self.count()):
+            geometries.append(self.widget(i).image_label.geometry_data)
+        try:
+            with open(file, 'r', encoding='utf-8') as source:
+                self.source_index = mapindex.SourceIndex(source.read(), geometries)
+        except OSError:
+            sys.stderr.write('Could not read IFM file: \'' + str(file) + '\'\n')
+            traceback.print_exc(file=sys.stderr)
+
+    @pyqtSlot(object)
+    def room_clicked(self, room):
+        if room.line is not None:
+            self.room_selected_signal.emit(room.line)
+
+    @pyqtSlot(int)
+    def highlight_line(self, line):
+        if not self.valid or self.source_index is None:
             return
-
-        # create png files
-        magnification = 2.0
-        if self.config.map_fig2dev_magnification_factor is not None \
-                and 0 < self.config.map_fig2dev_magnification_factor < 10:
-            magnification = float(self.config.map_fig2dev_magnification_factor + 1) / 2
-            pass
-
-        if section is not None:
-            png = base.joinpath(file.stem + '_qtifm' + section + '.png')
-        else:
-            png = base.joinpath(file.stem + '_qtifm.png')
-
-        status, output = subprocess.getstatusoutput(
-            self.config.map_fig2dev_command + ' -L png -m ' + str(magnification) + '  -S 4 -b 5 "' + str(
-                fig) + '" "' + str(png) + '"')
-        if status != 0:
-            self.valid = False
-            self.display_message(_('An error occurred while running FIG2DEV to create the images!'), error=output)
+        section, room = self.source_index.room_for_line(line)
+        for i in range(0, self.count()):
+            if i != section:
+                self.widget(i).highlight_room(None)
+        if room is None:
             return
-
-        # display images
-        viewer = ImageViewer(self.map_view_changed_signal)
-        viewer.load_image(png)
-        self.addTab(viewer, name)
-
-        if scale_factor is not None:
-            viewer.scale_image(scale_factor, absolute=True)
+        if section != self.currentIndex():
+            self.setCurrentIndex(section)
+        self.widget(section).highlight_room(room)
 
     def update_zoom_factor_status(self):
         if self.valid:
@@ -621,9 +1218,21 @@ class SettingsDialog(QDialog):
         self.magnifcation_factor_edit.setRange(1, 9)
         self.magnifcation_factor_edit.setValue(1)
 
+        self.process_timeout_edit = self.__spinbox()
+        self.process_timeout_edit.setRange(0, 3600)
+        self.process_timeout_edit.setSpecialValueText(_('No limit'))
+        self.process_timeout_edit.setSuffix(' s')
+
+        self.preview_format_combo = QComboBox()
+        self.preview_format_combo.setFixedWidth(400)
+        self.preview_format_combo.addItem(_('PNG (small files)'), 'png')
+        self.preview_format_combo.addItem(_('PPM (uncompressed, faster)'), 'ppm')
+
         self.image_per_map_check = QCheckBox(_('Create an image for each map section'))
         self.helvetica_check = QCheckBox(_('Use Helvetica as default font'))
         self.dark_theme_check = QCheckBox(_('Syntax highlighting for dark themes'))
+        self.watchdog_check = QCheckBox(_('Log stalls of the user interface'))
+        self.prefetch_check = QCheckBox(_('Create the maps of recent files in the background'))
 
         dlglyt = QVBoxLayout()
         dlglyt.setSizeConstraint(QLayout.SetFixedSize)
@@ -644,9 +1253,17 @@ class SettingsDialog(QDialog):
         grid.addWidget(self.__label(_('Magnification factor:')), 2, 0)
         grid.addWidget(self.magnifcation_factor_edit, 2, 1, 1, 2)
 
-        grid.addWidget(self.image_per_map_check, 3, 1, 1, 2)
-        grid.addWidget(self.helvetica_check, 4, 1, 1, 2)
-        grid.addWidget(self.dark_theme_check, 5, 1, 1, 2)
+        grid.addWidget(self.__label(_('Process timeout:')), 3, 0)
+        grid.addWidget(self.process_timeout_edit, 3, 1, 1, 2)
+
+        grid.addWidget(self.__label(_('Map image format:')), 4, 0)
+        grid.addWidget(self.preview_format_combo, 4, 1, 1, 2)
+
+        grid.addWidget(self.image_per_map_check, 5, 1, 1, 2)
+        grid.addWidget(self.helvetica_check, 6, 1, 1, 2)
+        grid.addWidget(self.dark_theme_check, 7, 1, 1, 2)
+        grid.addWidget(self.watchdog_check, 8, 1, 1, 2)
+        grid.addWidget(self.prefetch_check, 9, 1, 1, 2)
 
         dlglyt.addSpacing(10)
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
@@ -677,6 +1294,255 @@ class SettingsDialog(QDialog):
         return button
 
 
+class ExportDialog(QDialog):
+
+    def __init__(self, config, file, sections, *args):
+        QDialog.__init__(self, *args)
+        self.setWindowTitle(_('Export'))
+
+        self.config = config
+        self.file = file
+        self.batch = None
+        self.jobs = []
+        self.errors = []
+        self.thread_pool = QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(max(1, os.cpu_count() or 1))
+
+        self.section_list = QListWidget()
+        self.section_list.setFixedHeight(150)
+        for section in sections:
+            item = QListWidgetItem(section[1])
+            item.setData(Qt.UserRole, section[0])
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked)
+            self.section_list.addItem(item)
+
+        self.format_combo = QComboBox()
+        for name, language, options in export.EXPORT_FORMATS:
+            self.format_combo.addItem(name)
+
+        self.magnifcation_factor_edit = QSpinBox()
+        self.magnifcation_factor_edit.setRange(1, 9)
+        self.magnifcation_factor_edit.setValue(config.map_fig2dev_magnification_factor)
+
+        self.directory_edit = QLineEdit(str(file.parent))
+        self.directory_edit.setFixedWidth(400)
+
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setValue(0)
+
+        dlglyt = QVBoxLayout()
+        dlglyt.setSizeConstraint(QLayout.SetFixedSize)
+        self.setLayout(dlglyt)
+
+        grid = QGridLayout()
+        dlglyt.addLayout(grid)
+        grid.setSpacing(10)
+
+        grid.addWidget(self.__label(_('Map sections:')), 0, 0)
+        grid.addWidget(self.section_list, 0, 1, 1, 2)
+        grid.addWidget(self.__label(_('Format:')), 1, 0)
+        grid.addWidget(self.format_combo, 1, 1, 1, 2)
+        grid.addWidget(self.__label(_('Magnification factor:')), 2, 0)
+        grid.addWidget(self.magnifcation_factor_edit, 2, 1, 1, 2)
+        grid.addWidget(self.__label(_('Directory:')), 3, 0)
+        grid.addWidget(self.directory_edit, 3, 1)
+        grid.addWidget(DirectoryFieldButton(QIcon.fromTheme('folder-open'), self, self.directory_edit, True), 3, 2)
+        grid.addWidget(self.progress_bar, 4, 1, 1, 2)
+
+        dlglyt.addSpacing(10)
+        self.button_box = QDialogButtonBox(QDialogButtonBox.Close)
+        self.export_button = self.button_box.addButton(_('Export'), QDialogButtonBox.AcceptRole)
+        self.cancel_button = self.button_box.addButton(QDialogButtonBox.Cancel)
+        self.cancel_button.setEnabled(False)
+        self.export_button.clicked.connect(self.start_export)
+        self.cancel_button.clicked.connect(self.cancel_export)
+        self.button_box.button(QDialogButtonBox.Close).clicked.connect(self.reject)
+        dlglyt.addWidget(self.button_box)
+
+    @staticmethod
+    def __label(name):
+        label = QLabel(name)
+        label.setAlignment(Qt.AlignRight)
+        return label
+
+    def running(self):
+        return self.batch is not None
+
+    @pyqtSlot()
+    def start_export(self):
+        directory = Path(self.directory_edit.text().strip())
+        if not directory.is_dir():
+            QMessageBox.critical(self, _('Export'), _('The directory "') + str(directory) + _('" doesn\'t exist!'),
+                                 QMessageBox.Ok)
+            return
+
+        sections = []
+        for i in range(0, self.section_list.count()):
+            item = self.section_list.item(i)
+            if item.checkState() == Qt.Checked:
+                sections.append([item.data(Qt.UserRole), item.text()])
+        if len(sections) == 0:
+            return
+
+        name, language, options = export.EXPORT_FORMATS[self.format_combo.currentIndex()]
+        self.batch = export.ExportBatch(self.config, self.file, directory, language, options,
+                                        self.magnifcation_factor_edit.value())
+        self.errors = []
+        self.jobs = []
+        self.progress_bar.setRange(0, len(sections))
+        self.progress_bar.setValue(0)
+        self.set_controls_enabled(False)
+
+        for section in sections:
+            job = export.ExportJob(self.batch, section[0], section[1])
+            job.setAutoDelete(False)
+            job.signals.finished.connect(self.job_finished)
+            self.jobs.append(job)
+            self.thread_pool.start(job)
+
+    @pyqtSlot()
+    def cancel_export(self):
+        if self.running():
+            self.batch.cancel()
+
+    @pyqtSlot(str, str)
+    def job_finished(self, name, error):
+        if len(error) > 0:
+            sys.stderr.write(error)
+            self.errors.append(name)
+        self.progress_bar.setValue(self.progress_bar.value() + 1)
+        if self.progress_bar.value() < self.progress_bar.maximum():
+            return
+
+        cancelled = self.batch.cancelled
+        self.batch.cleanup()
+        self.batch = None
+        self.jobs = []
+        self.set_controls_enabled(True)
+        if cancelled:
+            self.progress_bar.setValue(0)
+        elif len(self.errors) > 0:
+            QMessageBox.critical(self, _('Export'), _(
+                'An error occurred while exporting the map sections:') + ' ' + ', '.join(self.errors) + '\n' +
+                _('See console output for details.'), QMessageBox.Ok)
+
+    def set_controls_enabled(self, enabled):
+        self.section_list.setEnabled(enabled)
+        self.format_combo.setEnabled(enabled)
+        self.magnifcation_factor_edit.setEnabled(enabled)
+        self.directory_edit.setEnabled(enabled)
+        self.export_button.setEnabled(enabled)
+        self.button_box.button(QDialogButtonBox.Close).setEnabled(enabled)
+        self.cancel_button.setEnabled(not enabled)
+
+    def reject(self):
+        if not self.running():
+            QDialog.reject(self)
+
+    def closeEvent(self, event):
+        if self.running():
+            event.ignore()
+        else:
+            event.accept()
+
+
+class ProjectSearchPanel(QWidget):
+    result_selected_signal = pyqtSignal(Path, int)
+
+    def __init__(self, config, *args):
+        QWidget.__init__(self, *args)
+
+        self.config = config
+        self.index = None
+        self.pending_query = None
+        self.search_pool = QThreadPool(self)
+        self.search_pool.setMaxThreadCount(1)
+
+        self.root_edit = QLineEdit(config.editor_project_root)
+        self.query_edit = QLineEdit()
+        self.query_edit.setPlaceholderText(_('Find in project'))
+        self.status_label = QLabel()
+        self.results = QTreeWidget()
+        self.results.setHeaderLabels([_('File'), _('Line'), _('Text')])
+        self.results.setRootIsDecorated(False)
+        self.results.setUniformRowHeights(True)
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(layout)
+        root = QHBoxLayout()
+        root.addWidget(QLabel(_('Directory:')))
+        root.addWidget(self.root_edit)
+        root.addWidget(DirectoryFieldButton(QIcon.fromTheme('folder-open'), self, self.root_edit, True))
+        layout.addLayout(root)
+        layout.addWidget(self.query_edit)
+        layout.addWidget(self.results)
+        layout.addWidget(self.status_label)
+
+        self.query_edit.returnPressed.connect(self.search)
+        self.root_edit.editingFinished.connect(self.root_changed)
+        self.results.itemActivated.connect(self.item_activated)
+
+    @pyqtSlot()
+    def root_changed(self):
+        root = self.root_edit.text().strip()
+        if root != self.config.editor_project_root:
+            self.config.editor_project_root = root
+            self.index = None
+
+    @pyqtSlot()
+    def search(self):
+        self.root_changed()
+        root = Path(self.config.editor_project_root)
+        if len(self.config.editor_project_root) == 0 or not root.is_dir():
+            self.status_label.setText(_('Choose the project directory first.'))
+            return
+
+        query = self.query_edit.text()
+        if self.pending_query is not None:
+            # a search is running, only the last query is started after it
+            self.pending_query = query
+            return
+        if self.index is None or self.index.root != root:
+            self.index = projectindex.ProjectIndex(root)
+
+        index = self.index
+        self.pending_query = query
+        self.status_label.setText(_('Searching...'))
+        tasks.start_task(projectindex.search_project, index, query, pool=self.search_pool,
+                         finished=lambda results: self.search_finished(index, query, results),
+                         failed=lambda error: self.search_finished(index, query, []))
+
+    def search_finished(self, index, query, results):
+        pending = self.pending_query
+        self.pending_query = None
+        if pending != query or index is not self.index:
+            # the query or the project root has changed meanwhile
+            self.search()
+            return
+
+        self.results.clear()
+        items = []
+        for result in results:
+            try:
+                name = str(result.path.relative_to(index.root))
+            except ValueError:
+                name = str(result.path)
+            item = QTreeWidgetItem([name, str(result.line), result.text.strip()])
+            item.setData(0, Qt.UserRole, str(result.path))
+            item.setData(1, Qt.UserRole, result.line)
+            items.append(item)
+        self.results.addTopLevelItems(items)
+        self.results.resizeColumnToContents(0)
+        self.status_label.setText(str(len(results)) + ' ' + _('matches in') + ' ' +
+                                  str(len(index.files)) + ' ' + _('files'))
+
+    @pyqtSlot(QTreeWidgetItem, int)
+    def item_activated(self, item, column):
+        self.result_selected_signal.emit(Path(item.data(0, Qt.UserRole)), item.data(1, Qt.UserRole))
+
+
 class MainWindow(QMainWindow):
 
     def __init__(self, *args):
@@ -696,6 +1562,7 @@ class MainWindow(QMainWindow):
         self.exit_action.setShortcut('Ctrl+Q')
         self.about_action = QAction(_('About'), self)
         self.about_action.setMenuRole(QAction.AboutRole)
+        self.stall_report_action = QAction(_('GUI Stalls'), self)
 
         self.new_action = QAction(QIcon.fromTheme('document-new'), _('New'))
         self.new_action.setShortcut('Ctrl+N')
@@ -706,12 +1573,17 @@ class MainWindow(QMainWindow):
         self.saveas_action = QAction(QIcon.fromTheme('document-save-as'), _('Save As...'))
         self.saveas_action.setShortcut('Shift+Ctrl+S')
         self.clear_recent_files_action = QAction(_('Clear Items'))
+        self.import_transcript_action = QAction(_('Import Transcript...'))
+        self.export_action = QAction(_('Export...'))
+        self.export_action.setShortcut('Ctrl+E')
         self.settings_action = QAction(_('Settings'))
 
         self.find_next_action = QAction(QIcon.fromTheme('down'), _('Find Next'))
         self.find_next_action.setShortcut('F3')
         self.find_previous_action = QAction(QIcon.fromTheme('up'), _('Find Previous'))
         self.find_previous_action.setShortcut('Ctrl+F3')
+        self.find_in_project_action = QAction(QIcon.fromTheme('edit-find'), _('Find in Project...'))
+        self.find_in_project_action.setShortcut('Shift+Ctrl+F')
 
         self.normal_size_action = QAction(QIcon.fromTheme('zoom-original'), _('Normal Size'))
         self.normal_size_action.setShortcut('Ctrl+0')
@@ -719,6 +1591,13 @@ class MainWindow(QMainWindow):
         self.zoom_in_action.setShortcut('Ctrl++')
         self.zoom_out_action = QAction(QIcon.fromTheme('zoom-out'), _('Zoom Out'))
         self.zoom_out_action.setShortcut('Ctrl+-')
+        self.dark_map_action = QAction(QIcon.fromTheme('weather-clear-night'), _('Dark Map'))
+        self.dark_map_action.setCheckable(True)
+        self.dark_map_action.setChecked(self.config.map_dark_mode)
+        self.show_changes_action = QAction(QIcon.fromTheme('view-refresh'), _('Show Changes'))
+        self.show_changes_action.setToolTip(_('Show the changes since the previous map images'))
+        self.show_changes_action.setCheckable(True)
+        self.show_changes_action.setEnabled(mapimage.numpy_available())
 
         # Menu Bar
         file_menu = self.menuBar().addMenu(_('File'))
@@ -728,13 +1607,23 @@ class MainWindow(QMainWindow):
         file_menu.addAction(self.save_action)
         file_menu.addAction(self.saveas_action)
         file_menu.addSeparator()
+        file_menu.addAction(self.import_transcript_action)
+        file_menu.addAction(self.export_action)
+        file_menu.addSeparator()
+        file_menu.addAction(self.find_in_project_action)
+        file_menu.addSeparator()
         file_menu.addAction(self.settings_action)
         file_menu.addSeparator()
         file_menu.addAction(self.exit_action)
 
         help_menu = self.menuBar().addMenu(_('Help'))
+        help_menu.addAction(self.stall_report_action)
         help_menu.addAction(self.about_action)
 
+        # the watchdog starts first, so it sees the stalls while loading the last file
+        self.stall_watchdog = None
+        self.update_watchdog()
+
         # Widgets
         self.splitter = QSplitter(Qt.Horizontal)
         self.splitter.setHandleWidth(5)
@@ -742,6 +1631,12 @@ class MainWindow(QMainWindow):
         self.map_view = MapView(self, self.config)
         self.find_edit = QLineEdit()
         self.find_edit.setFixedWidth(200)
+        self.project_search = ProjectSearchPanel(self.config)
+        self.project_search_dock = QDockWidget(_('Find in Project'), self)
+        self.project_search_dock.setObjectName('project-search')
+        self.project_search_dock.setWidget(self.project_search)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.project_search_dock)
+        self.project_search_dock.hide()
 
         # Tool bar
         tool_bar = self.addToolBar('Edit')
@@ -760,6 +1655,8 @@ class MainWindow(QMainWindow):
         tool_bar.addAction(self.normal_size_action)
         tool_bar.addAction(self.zoom_in_action)
         tool_bar.addAction(self.zoom_out_action)
+        tool_bar.addAction(self.dark_map_action)
+        tool_bar.addAction(self.show_changes_action)
 
         # Connects
         self.new_action.triggered.connect(self.editor.new_file)
@@ -767,20 +1664,36 @@ class MainWindow(QMainWindow):
         self.save_action.triggered.connect(self.editor.save_file)
         self.saveas_action.triggered.connect(self.editor.save_file_as)
         self.about_action.triggered.connect(self.show_about_dialog)
+        self.stall_report_action.triggered.connect(self.show_stall_report)
         self.clear_recent_files_action.triggered.connect(self.editor.clear_recent_files)
         self.settings_action.triggered.connect(self.show_settings)
+        self.export_action.triggered.connect(self.show_export)
+        self.import_transcript_action.triggered.connect(self.editor.import_transcript)
         self.exit_action.triggered.connect(self.close)
         self.normal_size_action.triggered.connect(self.map_view.normal_size)
         self.zoom_in_action.triggered.connect(self.map_view.zoom_in)
         self.zoom_out_action.triggered.connect(self.map_view.zoom_out)
+        self.dark_map_action.toggled.connect(self.dark_map_toggled)
+        self.show_changes_action.toggled.connect(self.map_view.set_show_changes)
         self.find_next_action.triggered.connect(self.find_next)
         self.find_previous_action.triggered.connect(self.find_previous)
+        self.find_in_project_action.triggered.connect(self.show_project_search)
+        self.project_search.result_selected_signal.connect(self.open_search_result)
 
         self.editor.map_changed_signal.connect(self.map_view.create_maps)
         self.editor.map_cleared_signal.connect(self.map_view.clear_maps)
+        self.editor.cursor_line_changed_signal.connect(self.map_view.highlight_line)
+        self.map_view.room_selected_signal.connect(self.editor.goto_line)
+        self.map_view.diagnostics_signal.connect(self.editor.set_diagnostics)
 
         self.map_view.map_view_changed_signal.connect(self.enable_map_actions)
 
+        # the recent files are rendered while idle, typing and interactive renders pause that at once
+        self.prefetcher = prefetch.RecentFilesPrefetcher(self.config, self)
+        self.editor.textChanged.connect(self.prefetcher.activity)
+        self.map_view.render_started_signal.connect(self.prefetcher.activity)
+        self.map_view.render_finished_signal.connect(self.prefetcher.activity)
+
         self.find_edit.textChanged.connect(self.find_edit_text_changed)
         self.find_edit.returnPressed.connect(self.find_next)
 
@@ -794,6 +1707,7 @@ class MainWindow(QMainWindow):
         self.statusBar().setSizeGripEnabled(False)
         self.statusBar().addWidget(self.editor.cursor_position_label, 1)
         self.statusBar().addWidget(self.editor.editor_modified_label)
+        self.statusBar().addWidget(self.editor.map_sections_label)
         self.statusBar().addWidget(self.map_view.zoom_factor_label)
 
         self.splitter.addWidget(self.editor)
@@ -804,31 +1718,59 @@ class MainWindow(QMainWindow):
 
         if self.config.editor_last_file is not None:
             self.editor.open_path(self.config.editor_last_file, check_modified=False)
+        if self.editor.current_file is None:
+            self.editor.start_journal(None, '')
 
         self.find_next_action.setEnabled(False)
         self.find_previous_action.setEnabled(False)
+        self.export_action.setEnabled(self.map_view.valid)
+        self.prefetcher.start()
 
     @pyqtSlot()
     def enable_map_actions(self):
         self.zoom_in_action.setEnabled(self.map_view.zoom_in_allowed())
         self.zoom_out_action.setEnabled(self.map_view.zoom_out_allowed())
         self.normal_size_action.setEnabled(self.map_view.valid)
+        self.export_action.setEnabled(self.map_view.valid)
         self.map_view.update_zoom_factor_status()
 
+    @pyqtSlot(bool)
+    def dark_map_toggled(self, checked):
+        self.config.map_dark_mode = checked
+        self.map_view.set_dark_mode(checked)
+
     @pyqtSlot()
     def show_about_dialog(self):
         dialog = AboutDialog(self)
         dialog.exec_()
 
+    @pyqtSlot()
+    def show_stall_report(self):
+        dialog = StallReportDialog(self.stall_watchdog, self)
+        dialog.exec_()
+
+    def update_watchdog(self):
+        if self.config.watchdog_enabled and self.stall_watchdog is None:
+            self.stall_watchdog = watchdog.StallWatchdog(self.config.watchdog_threshold, self)
+            self.stall_watchdog.start()
+        elif not self.config.watchdog_enabled and self.stall_watchdog is not None:
+            self.stall_watchdog.stop()
+            self.stall_watchdog = None
+
     @pyqtSlot()
     def show_settings(self):
         dialog = SettingsDialog(self)
         dialog.ifm_command_edit.setText(self.config.map_ifm_command)
         dialog.fig2dev_command_edit.setText(self.config.map_fig2dev_command)
         dialog.magnifcation_factor_edit.setValue(self.config.map_fig2dev_magnification_factor)
+        dialog.process_timeout_edit.setValue(self.config.map_process_timeout)
+        dialog.preview_format_combo.setCurrentIndex(max(0, dialog.preview_format_combo.findData(
+            self.config.map_preview_format)))
         dialog.dark_theme_check.setChecked(self.config.editor_dark_theme)
         dialog.helvetica_check.setChecked(self.config.map_ifm_helvetica_as_default)
         dialog.image_per_map_check.setChecked(self.config.map_ifm_create_image_per_map)
+        dialog.watchdog_check.setChecked(self.config.watchdog_enabled)
+        dialog.prefetch_check.setChecked(self.config.map_prefetch_recent_files)
         dark_theme = self.config.editor_dark_theme
 
         result = dialog.exec_()
@@ -836,13 +1778,37 @@ class MainWindow(QMainWindow):
             self.config.map_ifm_command = dialog.ifm_command_edit.text().strip()
             self.config.map_fig2dev_command = dialog.fig2dev_command_edit.text().strip()
             self.config.map_fig2dev_magnification_factor = dialog.magnifcation_factor_edit.value()
+            self.config.map_process_timeout = dialog.process_timeout_edit.value()
+            self.config.map_preview_format = dialog.preview_format_combo.currentData()
             self.config.editor_dark_theme = dialog.dark_theme_check.isChecked()
             self.config.map_ifm_helvetica_as_default = dialog.helvetica_check.isChecked()
             self.config.map_ifm_create_image_per_map = dialog.image_per_map_check.isChecked()
+            self.config.watchdog_enabled = dialog.watchdog_check.isChecked()
+            self.config.map_prefetch_recent_files = dialog.prefetch_check.isChecked()
+            self.update_watchdog()
 
             if self.config.editor_dark_theme != dark_theme:
                 self.editor.reset_highlighter(self.config.editor_dark_theme)
 
+    @pyqtSlot()
+    def show_export(self):
+        if self.map_view.valid and self.map_view.last_file is not None:
+            dialog = ExportDialog(self.config, self.map_view.last_file, self.map_view.sections, self)
+            dialog.exec_()
+
+    @pyqtSlot()
+    def show_project_search(self):
+        self.project_search_dock.show()
+        self.project_search.query_edit.setFocus()
+        self.project_search.query_edit.selectAll()
+
+    @pyqtSlot(Path, int)
+    def open_search_result(self, path, line):
+        if self.editor.current_file != path:
+            self.editor.open_path(path)
+        if self.editor.current_file == path:
+            self.editor.goto_line(line)
+
     @pyqtSlot()
     def find_edit_text_changed(self):
         flag = len(self.find_edit.text()) > 0
@@ -862,9 +1828,14 @@ class MainWindow(QMainWindow):
             self.editor.find(text, QTextDocument.FindBackward)
 
     def closeEvent(self, event):
+        self.editor.wait_for_save()
         if self.editor.abort_if_modified(_('Exit')):
             event.ignore()
         else:
+            self.editor.journal.discard()
+            self.prefetcher.stop()
+            if self.stall_watchdog is not None:
+                self.stall_watchdog.stop()
             event.accept()
 
         self.config.mainwindow_witdh = self.width()
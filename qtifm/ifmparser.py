@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# A fast check of IFM source while typing: a lexer and a parser of the statement structure.
+#
+# Only problems ifm is sure to reject are reported as errors: unterminated strings, missing
+# semicolons, statements without their required arguments and tags referenced by 'from', 'link' and
+# 'join' but never defined. Files with errors aren't given to ifm at all, so everything the parser
+# doesn't model completely is a warning: unknown characters and statements, the values of 'dir',
+# 'go', 'require' and variables, tags defined twice and strings spanning lines. Undefined tags are
+# warnings too if there is an unknown statement, it may define them.
+#
+
+import re
+
+from diagnostics import Diagnostic, SEVERITY_ERROR, SEVERITY_WARNING
+
+TOKEN_ID = 'id'
+TOKEN_STRING = 'string'
+TOKEN_NUMBER = 'number'
+TOKEN_SEMICOLON = ';'
+TOKEN_EQUALS = '='
+TOKEN_DOT = '.'
+TOKEN_END = 'end'
+
+# whitespace and comments are skipped as part of the following token, no token starts within them
+TOKEN_PATTERN = re.compile(r'''
+    (?:\s+|\#[^\n]*(?=\n|\Z))*
+    (?:
+        (?P<string>"(?:[^"\\]|\\.)*")
+      | (?P<unterminated>")
+      | (?P<number>[+-]?[0-9]+(?:\.[0-9]+)?)
+      | (?P<id>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<punct>[;=.])
+      | (?P<other>[^\s\#])
+    )
+''', re.VERBOSE)
+
+STATEMENTS = {'title', 'map', 'require', 'room', 'item', 'link', 'join', 'task', 'style', 'endstyle'}
+# statements which can't appear as attributes, so they can't be inside another statement
+STATEMENT_STARTS = {'title', 'map', 'require', 'room', 'item', 'task', 'endstyle'}
+DIRECTIONS = {'n', 's', 'e', 'w', 'ne', 'nw', 'se', 'sw', 'north', 'south', 'east', 'west',
+              'northeast', 'northwest', 'southeast', 'southwest'}
+GO_DIRECTIONS = {'up', 'down', 'in', 'out', 'u', 'd'}
+# references to the last defined object instead of a tag
+SPECIAL_TAGS = {'it', 'last', 'them', 'any', 'all', 'none'}
+
+
+class Token:
+    __slots__ = ('kind', 'value', 'column')
+
+    def __init__(self, kind, value, column):
+        self.kind = kind
+        self.value = value
+        self.column = column
+
+
+
+class ParseResult:
+
+    def __init__(self):
+        self.diagnostics = []
+        self.rooms = 0
+        self.sections = 0
+
+    @property
+    def errors(self):
+        return [d for d in self.diagnostics if d.severity == SEVERITY_ERROR]
+
+    def valid(self):
+        return len(self.errors) == 0
+
+    def add(self, line, column, severity, message):
+        self.diagnostics.append(Diagnostic(line, severity, message, column))
+
+    def output(self):
+        # the diagnostics formatted like the messages of ifm
+        return '\n'.join('{}: line {}, column {}: {}'.format(d.severity, d.line, d.column, d.message)
+                         for d in self.diagnostics)
+
+
+def tokenize_line(line):
+    # Returns [tokens, [(column, severity, message)], None] for a line, None if a string continues on
+    # the next line. The parser keeps the summary of the statements of the line in the last field.
+    tokens = []
+    problems = []
+    position = 0
+    match_token = TOKEN_PATTERN.match
+    while True:
+        match = match_token(line, position)
+        if match is None:
+            break  # only whitespace and comments left
+        kind = match.lastgroup
+        start = match.start(kind)
+        position = match.end()
+        if kind == 'string':
+            tokens.append(Token(TOKEN_STRING, match.group(kind)[1:-1], start + 1))
+        elif kind == 'punct':
+            tokens.append(Token(match.group(kind), match.group(kind), start + 1))
+        elif kind == 'unterminated':
+            return None
+        elif kind == 'other':
+            problems.append((start + 1, SEVERITY_WARNING, 'unexpected character \'' + match.group(kind) + '\''))
+        else:
+            tokens.append(Token(kind, match.group(kind), start + 1))
+    return [tokens, problems, None]
+
+
+def tokenize_text(text, position, line, tokens, lines, result):
+    # tokenizes the text from position (the start of line) to the end, strings may span lines here
+    line_start = position
+    counted = position  # the newlines before this position are counted
+    match_token = TOKEN_PATTERN.match
+    while True:
+        match = match_token(text, position)
+        if match is None:
+            break
+        kind = match.lastgroup
+        start = match.start(kind)
+        position = match.end()
+        newlines = text.count('\n', counted, start)
+        if newlines > 0:
+            line += newlines
+            line_start = text.rindex('\n', counted, start) + 1
+        counted = start
+
+        column = start - line_start + 1
+        value = match.group(kind)
+        if kind == 'string':
+            value = value[1:-1]
+            if '\n' in value:
+                # allowed, but mostly a missing quote
+                result.add(line, column, SEVERITY_WARNING, 'the string continues on the next line')
+        elif kind == 'punct':
+            kind = value
+        elif kind == 'unterminated':
+            # the rest of the line is taken as the string
+            result.add(line, column, SEVERITY_ERROR, 'unterminated string')
+            end = text.find('\n', start)
+            position = end if end >= 0 else len(text)
+            kind = TOKEN_STRING
+            value = text[start + 1:position]
+        elif kind == 'other':
+            result.add(line, column, SEVERITY_WARNING, 'unexpected character \'' + value + '\'')
+            continue
+        tokens.append(Token(kind, value, column))
+        lines.append(line)
+
+
+class Tokenizer:
+    # Tokenizes the text line by line and keeps the tokens of every line for the next call, so only
+    # the changed lines are tokenized (and parsed) again while typing. Strings spanning lines are
+    # rare, from the first one on the rest of the text is tokenized as a whole.
+
+    def __init__(self):
+        self.cache = {}  # line text -> tokenize_line()
+
+    def tokenize(self, text, result):
+        # Returns the tokens, the line of every token and the line entries by the position of their
+        # first token. Lexical errors are added to the result.
+        tokens = []
+        lines = []
+        starts = {}
+        cache = self.cache
+        used = {}
+        position = 0
+        for number, line in enumerate(text.split('\n'), 1):
+            entry = cache.get(line)
+            if entry is None:
+                entry = tokenize_line(line)
+            if entry is None:
+                tokenize_text(text, position, number, tokens, lines, result)
+                break
+            used[line] = entry
+            line_tokens, problems, summary = entry
+            if len(line_tokens) > 0:
+                starts[len(tokens)] = entry
+                tokens.extend(line_tokens)
+                lines.extend([number] * len(line_tokens))
+            for column, severity, message in problems:
+                result.add(number, column, severity, message)
+            position += len(line) + 1
+        self.cache = used  # only the lines of the current text are kept
+        return tokens, lines, starts
+
+
+class Parser:
+
+    def __init__(self, tokens, lines, result, starts=None):
+        self.tokens = tokens
+        self.lines = lines
+        self.starts = starts if starts is not None else {}
+        self.position = 0
+        self.result = result
+        self.definitions = []  # the positions of the defined tags
+        self.references = []  # the positions of the referenced tags
+        self.unknown = 0  # the number of unknown statements
+
+    def next(self):
+        token = self.tokens[self.position]
+        if token.kind != TOKEN_END:
+            self.position += 1
+        return token
+
+    def peek(self):
+        return self.tokens[self.position]
+
+    def error(self, message, position=None):
+        # at the current token by default, tokens are shared between lines with the same text
+        position = self.position if position is None else position
+        self.result.add(self.lines[position], self.tokens[position].column, SEVERITY_ERROR, message)
+
+    def warning(self, message, position):
+        self.result.add(self.lines[position], self.tokens[position].column, SEVERITY_WARNING, message)
+
+    def expect(self, kind, message):
+        token = self.peek()
+        if token.kind != kind:
+            self.error(message)
+            return None
+        return self.next()
+
+    def parse(self):
+        while self.peek().kind != TOKEN_END:
+            entry = self.starts.get(self.position)
+            if entry is None:
+                self.statement()
+            elif entry[2] is not None:
+                self.apply_summary(entry)
+            else:
+                self.line_statements(entry)
+
+        tags = set()
+        for position in self.definitions:
+            tag = self.tokens[position].value
+            if tag in tags:
+                self.warning('tag \'' + tag + '\' is already defined', position)
+            tags.add(tag)
+        report = self.error if self.unknown == 0 else self.warning
+        for position in self.references:
+            if self.tokens[position].value not in tags:
+                report('tag \'' + self.tokens[position].value + '\' is not defined', position)
+        self.result.diagnostics.sort(key=lambda d: (d.line, d.column))
+        return self.result
+
+    def line_statements(self, entry):
+        # Parses the statements starting on the line. If the last one ends with a semicolon at the
+        # end of the line, they don't depend on the other lines and the summary is kept in the entry.
+        start = self.position
+        end = start + len(entry[0])
+        diagnostics = len(self.result.diagnostics)
+        definitions = len(self.definitions)
+        references = len(self.references)
+        rooms = self.result.rooms
+        sections = self.result.sections
+        unknown = self.unknown
+        while self.position < end and self.peek().kind != TOKEN_END:
+            self.statement()
+        if self.position != end or entry[0][-1].kind != TOKEN_SEMICOLON:
+            return
+
+        entry[2] = ([(d.column, d.severity, d.message) for d in self.result.diagnostics[diagnostics:]],
+                    [position - start for position in self.definitions[definitions:]],
+                    [position - start for position in self.references[references:]],
+                    self.result.rooms - rooms, self.result.sections - sections, self.unknown - unknown)
+
+    def apply_summary(self, entry):
+        start = self.position
+        line = self.lines[start]
+        diagnostics, definitions, references, rooms, sections, unknown = entry[2]
+        for column, severity, message in diagnostics:
+            self.result.add(line, column, severity, message)
+        for offset in definitions:
+            self.definitions.append(start + offset)
+        for offset in references:
+            self.references.append(start + offset)
+        self.result.rooms += rooms
+        self.result.sections += sections
+        self.unknown += unknown
+        self.position = start + len(entry[0])
+
+    def statement(self):
+        position = self.position
+        token = self.next()
+        if token.kind == TOKEN_SEMICOLON:
+            return
+        if token.kind != TOKEN_ID:
+            self.error('statement expected', position)
+            self.skip()
+            return
+
+        keyword = token.value
+        if keyword in ('title', 'map'):
+            self.expect(TOKEN_STRING, 'string expected after \'' + keyword + '\'')
+        elif keyword == 'require':
+            if self.peek().kind != TOKEN_NUMBER:
+                self.warning('version number expected after \'require\'', self.position)
+        elif keyword in ('room', 'item', 'task'):
+            if self.expect(TOKEN_STRING, 'name expected after \'' + keyword + '\'') is None:
+                self.skip()
+                return
+        elif keyword in ('link', 'join'):
+            if not self.reference(keyword) or self.expect_keyword('to') is None or not self.reference('to'):
+                self.skip()
+                return
+        elif keyword in ('style', 'endstyle'):
+            if self.peek().kind == TOKEN_ID:
+                self.next()
+        elif self.peek().kind == TOKEN_DOT:
+            # a variable of an output format, FORMAT.name = value
+            self.next()
+            if self.expect(TOKEN_ID, 'variable name expected after \'.\'') is None \
+                    or self.expect(TOKEN_EQUALS, '\'=\' expected after the variable name') is None:
+                self.skip()
+                return
+            self.value()
+        elif self.peek().kind == TOKEN_EQUALS:
+            self.next()
+            self.value()
+        else:
+            self.warning('unknown statement \'' + keyword + '\'', position)
+            self.unknown += 1
+            self.skip()
+            return
+
+        self.attributes(keyword)
+
+    def value(self):
+        if self.peek().kind not in (TOKEN_NUMBER, TOKEN_STRING, TOKEN_ID):
+            self.warning('value expected after \'=\'', self.position)
+
+    def expect_keyword(self, keyword):
+        token = self.peek()
+        if token.kind != TOKEN_ID or token.value != keyword:
+            self.error('\'' + keyword + '\' expected')
+            return None
+        return self.next()
+
+    def reference(self, after):
+        token = self.peek()
+        if token.kind != TOKEN_ID:
+            self.error('tag expected after \'' + after + '\'')
+            return False
+        if token.value not in SPECIAL_TAGS:
+            self.references.append(self.position)
+        self.next()
+        return True
+
+    def attributes(self, keyword):
+        has_dir = False
+        while True:
+            token = self.peek()
+            if token.kind == TOKEN_SEMICOLON:
+                self.next()
+                break
+            if token.kind == TOKEN_END:
+                self.error('\';\' expected at the end of the file')
+                break
+            if token.kind == TOKEN_ID and token.value in STATEMENT_STARTS:
+                self.error('\';\' expected before \'' + token.value + '\'')
+                break  # the next statement starts here
+            self.next()
+            if token.kind != TOKEN_ID:
+                continue
+
+            if token.value == 'tag':
+                tag = self.peek()
+                if tag.kind != TOKEN_ID:
+                    self.error('tag expected after \'tag\'')
+                    continue
+                self.definitions.append(self.position)
+                self.next()
+            elif token.value == 'dir':
+                has_dir = True
+                if self.peek().kind != TOKEN_ID or self.peek().value not in DIRECTIONS:
+                    self.warning('direction expected after \'dir\'', self.position)
+            elif token.value == 'from' and keyword == 'room':
+                self.reference('from')
+            elif token.value == 'go':
+                if self.peek().kind != TOKEN_ID or self.peek().value not in GO_DIRECTIONS:
+                    self.warning('up, down, in or out expected after \'go\'', self.position)
+
+        if keyword == 'room':
+            # rooms without a direction start a new map section
+            self.result.rooms += 1
+            if not has_dir:
+                self.result.sections += 1
+
+    def skip(self):
+        # error recovery: continues after the next semicolon or before the next statement
+        while True:
+            token = self.peek()
+            if token.kind == TOKEN_END:
+                return
+            if token.kind == TOKEN_ID and token.value in STATEMENT_STARTS:
+                return
+            self.next()
+            if token.kind == TOKEN_SEMICOLON:
+                return
+
+
+def parse(text, tokenizer=None):
+    # a tokenizer kept between the calls tokenizes only the changed lines again
+    result = ParseResult()
+    tokenizer = tokenizer if tokenizer is not None else Tokenizer()
+    tokens, lines, starts = tokenizer.tokenize(text, result)
+    last_line = text.rfind('\n') + 1
+    tokens.append(Token(TOKEN_END, '', len(text) - last_line + 1))
+    lines.append(text.count('\n', 0, last_line) + 1)
+    return Parser(tokens, lines, result, starts).parse()
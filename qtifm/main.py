@@ -4,17 +4,33 @@
 # qtifm main file
 #
 
+import argparse
 import gui
+import session
 import sys
+import tasks
 
+from pathlib import Path
 from PyQt5.QtWidgets import QApplication
 
 
 def main(argv):
-    app = QApplication(argv)
+    parser = argparse.ArgumentParser(description='qtIFM')
+    parser.add_argument('--record', type=Path, metavar='FILE',
+                        help='record the session to FILE, it can be replayed by replay.py')
+    args, qt_args = parser.parse_known_args(argv[1:])
+
+    app = QApplication(argv[:1] + qt_args)
     mainwindow = gui.MainWindow()
+    recorder = None
+    if args.record is not None:
+        recorder = session.SessionRecorder(mainwindow, args.record)
     mainwindow.show()
-    sys.exit(app.exec_())
+    status = app.exec_()
+    tasks.task_pool().waitForDone()  # let background tasks finish before python shuts down
+    if recorder is not None:
+        recorder.close()
+    sys.exit(status)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Pixel operations on the map images. NumPy is optional, without it the slower Qt fallbacks are used.
+#
+
+import os
+import tempfile
+
+from pathlib import Path
+from PyQt5.QtCore import QSize, Qt
+from PyQt5.QtGui import QImage, QImageReader
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DARK_BACKGROUND = (0x23, 0x26, 0x29)
+
+# rows transformed at once, keeps the temporary arrays small for huge images
+CHUNK_ROWS = 256
+
+# changes are found per tile of DIFF_TILE x DIFF_TILE pixels, more regions are merged into one
+DIFF_TILE = 16
+MAX_REGIONS = 200
+
+# the formats decoded at a smaller size directly, the others (png, ppm) are decoded at full size and
+# scaled afterwards, even when their handler accepts a scaled size
+SCALED_DECODE_FORMATS = {b'jpeg', b'jpg'}
+
+
+def numpy_available():
+    return numpy is not None
+
+
+def image_array(image):
+    # A (height, width, 4) view on the pixels of a 32 bit image, without copying. The channel order
+    # is B, G, R, A on little endian machines. Writing to the array changes the image.
+    ptr = image.bits()
+    ptr.setsize(image.bytesPerLine() * image.height())
+    rows = numpy.frombuffer(ptr, numpy.uint8).reshape(image.height(), image.bytesPerLine())
+    return rows[:, :image.width() * 4].reshape(image.height(), image.width(), 4)
+
+
+def dark_file(filename):
+    filename = Path(filename)
+    return filename.with_name(filename.stem + '_dark' + filename.suffix)
+
+
+def darken_image(image, background=DARK_BACKGROUND):
+    # Inverts the lightness and keeps hue and saturation: adding 255 - max - min to all channels
+    # maps (max + min) / 2 to 255 - (max + min) / 2. Black becomes white and the white
+    # background becomes the dark background color.
+    if image.format() not in (QImage.Format_RGB32, QImage.Format_ARGB32):
+        image = image.convertToFormat(QImage.Format_ARGB32)  # 32 bit images are changed in place
+    if numpy is None:
+        image.invertPixels()
+        return image
+
+    pixels = image_array(image)
+    # the background color mapping as lookup table per channel: 0 -> background, 255 -> 255
+    tables = [numpy.array([c + v * (255 - c) // 255 for v in range(0, 256)], numpy.uint8)
+              for c in reversed(background)]
+    for row in range(0, image.height(), CHUNK_ROWS):
+        channels = [pixels[row:row + CHUNK_ROWS, :, i] for i in range(0, 3)]
+        highest = numpy.maximum(numpy.maximum(channels[0], channels[1]), channels[2])
+        lowest = numpy.minimum(numpy.minimum(channels[0], channels[1]), channels[2])
+        delta = 255 - highest.astype(numpy.int16) - lowest
+        for channel, table in zip(channels, tables):
+            channel[...] = table.take(channel + delta)
+    return image
+
+
+def decode_image(filename, scale=1.0):
+    # returns the image, decoded at the given scale, and its full size
+    reader = QImageReader(str(filename))
+    size = reader.size()
+    if scale >= 1.0 or not size.isValid():
+        return reader.read(), size
+    scaled = QSize(max(1, int(size.width() * scale)), max(1, int(size.height() * scale)))
+    if reader.format() in SCALED_DECODE_FORMATS:
+        reader.setScaledSize(scaled)
+        return reader.read(), size
+    image = reader.read()
+    if not image.isNull():
+        image = image.scaled(scaled, transformMode=Qt.SmoothTransformation)
+    return image, size
+
+
+def load_dark_image(filename, scale=1.0):
+    # loads the dark variant of a map image, it's created and saved next to the original on first use
+    target = dark_file(filename)
+    if target.exists():
+        image, size = decode_image(target, scale)
+        if not image.isNull():
+            return image, size
+
+    image = QImage(str(filename))
+    if image.isNull():
+        return image, image.size()
+    image = darken_image(image)
+    save_atomic(image, target)
+    size = image.size()
+    if scale < 1.0:
+        image = image.scaled(max(1, int(size.width() * scale)), max(1, int(size.height() * scale)),
+                             transformMode=Qt.SmoothTransformation)
+    return image, size
+
+
+def save_atomic(image, target):
+    # other instances may read the cache entry at the same time, so the image is written to a
+    # temporary file and renamed, like the render results
+    try:
+        fd, temp = tempfile.mkstemp(prefix='.' + target.name + '.', suffix='.tmp', dir=str(target.parent))
+        os.close(fd)
+        if image.save(temp, target.suffix[1:]):
+            os.replace(temp, str(target))
+        else:
+            os.unlink(temp)
+    except OSError:
+        pass  # it's created again next time
+
+
+def changed_tiles(old, new, tile=DIFF_TILE):
+    # A (rows, columns) bool array marking the tiles of the new image which differ from the old image.
+    # The images are compared in chunks of rows, a pixel as one 32 bit value. Parts of the new image
+    # outside the old one count as changed.
+    width, height = new.width(), new.height()
+    tiles = numpy.ones(((height + tile - 1) // tile, (width + tile - 1) // tile), bool)
+    common_width, common_height = min(width, old.width()), min(height, old.height())
+    old_pixels = image_array(old).view(numpy.uint32)[:, :, 0]
+    new_pixels = image_array(new).view(numpy.uint32)[:, :, 0]
+
+    chunk = max(tile, CHUNK_ROWS // tile * tile)
+    padding = -common_width % tile
+    for row in range(0, common_height, chunk):
+        end = min(row + chunk, common_height)
+        diff = old_pixels[row:end, :common_width] != new_pixels[row:end, :common_width]
+        diff = numpy.pad(diff, ((0, -(end - row) % tile), (0, padding)), 'constant')
+        reduced = diff.reshape(diff.shape[0] // tile, tile, diff.shape[1] // tile, tile).any(axis=(1, 3))
+        tiles[row // tile:row // tile + reduced.shape[0], :reduced.shape[1]] = reduced
+
+    if width > common_width:
+        tiles[:, common_width // tile:] = True
+    if height > common_height:
+        tiles[common_height // tile:, :] = True
+    return tiles
+
+
+def tile_regions(tiles, tile, width, height):
+    # Bounding boxes (x1, y1, x2, y2) in pixels of the groups of changed tiles. Tiles up to one tile
+    # apart are grouped, so a changed label or link doesn't fall apart into many small boxes.
+    grown = tiles.copy()
+    grown[1:, :] |= tiles[:-1, :]
+    grown[:-1, :] |= tiles[1:, :]
+    rows = grown.copy()
+    grown[:, 1:] |= rows[:, :-1]
+    grown[:, :-1] |= rows[:, 1:]
+
+    changed = set(zip(*[a.tolist() for a in numpy.nonzero(tiles)]))
+    remaining = set(zip(*[a.tolist() for a in numpy.nonzero(grown)]))
+    regions = []
+    while len(remaining) > 0:
+        stack = [remaining.pop()]
+        box = None
+        while len(stack) > 0:
+            r, c = stack.pop()
+            if (r, c) in changed:
+                if box is None:
+                    box = [c, r, c, r]
+                else:
+                    box = [min(box[0], c), min(box[1], r), max(box[2], c), max(box[3], r)]
+            for neighbour in ((r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1)):
+                if neighbour in remaining:
+                    remaining.remove(neighbour)
+                    stack.append(neighbour)
+        if box is not None:
+            regions.append((box[0] * tile, box[1] * tile, min(width, (box[2] + 1) * tile),
+                            min(height, (box[3] + 1) * tile)))
+
+    if len(regions) > MAX_REGIONS:
+        regions = [(min(r[0] for r in regions), min(r[1] for r in regions),
+                    max(r[2] for r in regions), max(r[3] for r in regions))]
+    regions.sort(key=lambda r: (r[2] - r[0]) * (r[3] - r[1]), reverse=True)
+    return regions
+
+
+def changed_regions(old_filename, new_filename, tile=DIFF_TILE):
+    # the changed regions of a map image against the image of an earlier render, as bounding boxes
+    # in pixels of the new image; None if the images can't be compared
+    if numpy is None:
+        return None
+    old = QImage(str(old_filename))
+    new = QImage(str(new_filename))
+    if old.isNull() or new.isNull():
+        return None
+    old = old.convertToFormat(QImage.Format_ARGB32)
+    new = new.convertToFormat(QImage.Format_ARGB32)
+    return tile_regions(changed_tiles(old, new, tile), tile, new.width(), new.height())
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Room and link geometry of the map sections, read from the fig files created by ifm
+#
+
+import bisect
+import re
+import sys
+import traceback
+
+# fig2dev renders bitmaps with 80 pixels per inch at magnification 1.0
+FIG2DEV_PPI = 80
+
+# box and arc-box polylines are the rooms, open polylines are the links
+FIG_POLYLINE = 1
+FIG_BOX = 2
+FIG_ARC_BOX = 4
+
+ROOM_PATTERN = re.compile(r'\broom\s+"((?:[^"\\]|\\.)*)"')
+
+
+def name_key(name):
+    # ifm wraps long room names over several text lines, so whitespace is ignored
+    return ''.join(name.split()).lower()
+
+
+class Rect:
+    __slots__ = ('x1', 'y1', 'x2', 'y2')
+
+    def __init__(self, x1, y1, x2, y2):
+        self.x1 = min(x1, x2)
+        self.y1 = min(y1, y2)
+        self.x2 = max(x1, x2)
+        self.y2 = max(y1, y2)
+
+    def contains(self, x, y, margin=0):
+        return self.x1 - margin <= x <= self.x2 + margin and self.y1 - margin <= y <= self.y2 + margin
+
+    def center(self):
+        return (self.x1 + self.x2) / 2, (self.y1 + self.y2) / 2
+
+    def width(self):
+        return self.x2 - self.x1
+
+    def height(self):
+        return self.y2 - self.y1
+
+
+class MapRoom:
+    __slots__ = ('name', 'rect', 'line')
+
+    def __init__(self, name, rect):
+        self.name = name
+        self.rect = rect
+        self.line = None
+
+
+class MapLink:
+    __slots__ = ('points', 'rect', 'from_room', 'to_room')
+
+    def __init__(self, points):
+        self.points = points
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        self.rect = Rect(min(xs), min(ys), max(xs), max(ys))
+        self.from_room = None
+        self.to_room = None
+
+    def distance(self, x, y):
+        best = None
+        for i in range(0, len(self.points) - 1):
+            d = segment_distance(x, y, self.points[i], self.points[i + 1])
+            if best is None or d < best:
+                best = d
+        return best
+
+
+def segment_distance(x, y, p1, p2):
+    dx = p2[0] - p1[0]
+    dy = p2[1] - p1[1]
+    if dx == 0 and dy == 0:
+        return ((x - p1[0]) ** 2 + (y - p1[1]) ** 2) ** 0.5
+    t = ((x - p1[0]) * dx + (y - p1[1]) * dy) / float(dx * dx + dy * dy)
+    t = max(0.0, min(1.0, t))
+    px = p1[0] + t * dx
+    py = p1[1] + t * dy
+    return ((x - px) ** 2 + (y - py) ** 2) ** 0.5
+
+
+class GridIndex:
+    # A uniform grid: every object is registered in each cell its bounding box touches,
+    # so a point query only looks at the objects of a single cell.
+
+    def __init__(self, cell_size):
+        self.cell_size = max(1, int(cell_size))
+        self.cells = {}
+
+    def insert(self, rect, obj):
+        cx1, cy1 = self.__cell(rect.x1, rect.y1)
+        cx2, cy2 = self.__cell(rect.x2, rect.y2)
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                self.cells.setdefault((cx, cy), []).append(obj)
+
+    def query(self, x, y):
+        return self.cells.get(self.__cell(x, y), [])
+
+    def __cell(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+
+class FigText:
+    __slots__ = ('x', 'y', 'size', 'text')
+
+    def __init__(self, x, y, size, text):
+        self.x = x
+        self.y = y
+        self.size = size
+        self.text = text
+
+
+class FigFile:
+
+    def __init__(self):
+        self.resolution = 1200
+        self.boxes = []
+        self.polylines = []
+        self.texts = []
+        self.bbox = None
+
+    def extend_bbox(self, x1, y1, x2, y2):
+        if self.bbox is None:
+            self.bbox = Rect(x1, y1, x2, y2)
+        else:
+            self.bbox = Rect(min(self.bbox.x1, x1), min(self.bbox.y1, y1),
+                             max(self.bbox.x2, x2), max(self.bbox.y2, y2))
+
+
+def unescape_fig_string(text):
+    if text.endswith('\\001'):
+        text = text[:-4]
+    return re.sub(r'\\(\\|[0-7]{3})', lambda m: '\\' if m.group(1) == '\\' else chr(int(m.group(1), 8)), text)
+
+
+def parse_fig(filename):
+    with open(str(filename), 'r', encoding='latin-1') as file:
+        lines = [line.rstrip('\n') for line in file if not line.startswith('#')]
+
+    fig = FigFile()
+    # header: orientation, justification, units, paper size, magnification, multiple page,
+    # transparent color and resolution
+    if len(lines) < 8:
+        return fig
+    try:
+        fig.resolution = int(lines[7].split()[0])
+    except (ValueError, IndexError):
+        pass
+
+    words = []
+    for line in lines[8:]:
+        if line.startswith('4 '):
+            # text objects end with the string, which may contain blanks
+            words.append(line)
+        else:
+            words.append(line.split())
+
+    i = 0
+    while i < len(words):
+        entry = words[i]
+        i += 1
+        if isinstance(entry, str):
+            parse_fig_text(fig, entry)
+            continue
+        if len(entry) == 0:
+            continue
+        kind = entry[0]
+        if kind in ('2', '3'):
+            # the forward and backward arrow flags and the number of points are the last fields of
+            # the header, polylines have 16 fields and splines 14
+            count_field = 15 if kind == '2' else 13
+            if len(entry) <= count_field:
+                continue
+            sub_type = int(entry[1])
+            thickness = int(entry[3])
+            count = int(entry[count_field])
+            i += int(entry[count_field - 2]) + int(entry[count_field - 1])  # arrow lines
+            values, i = collect_numbers(words, i, count * 2)
+            if kind == '3':
+                ignore, i = collect_numbers(words, i, count)  # spline control points
+            points = [(int(values[j]), int(values[j + 1])) for j in range(0, len(values) - 1, 2)]
+            if len(points) == 0:
+                continue
+            margin = thickness * fig.resolution / 160
+            fig.extend_bbox(min(p[0] for p in points) - margin, min(p[1] for p in points) - margin,
+                            max(p[0] for p in points) + margin, max(p[1] for p in points) + margin)
+            if kind == '2' and sub_type in (FIG_BOX, FIG_ARC_BOX):
+                xs = [p[0] for p in points]
+                ys = [p[1] for p in points]
+                fig.boxes.append(Rect(min(xs), min(ys), max(xs), max(ys)))
+            elif sub_type == FIG_POLYLINE or kind == '3':
+                fig.polylines.append(points)
+        elif kind == '5' and len(entry) >= 20:
+            i += int(entry[12]) + int(entry[13])  # arcs have their points in the header
+
+    return fig
+
+
+def collect_numbers(words, i, count):
+    values = []
+    while len(values) < count and i < len(words):
+        entry = words[i]
+        if isinstance(entry, str):
+            break
+        values.extend(float(v) for v in entry)
+        i += 1
+    return values, i
+
+
+def parse_fig_text(fig, line):
+    parts = line.split(None, 13)
+    if len(parts) < 14:
+        return
+    try:
+        justification = int(parts[1])
+        size = float(parts[6])
+        height = float(parts[9])
+        length = float(parts[10])
+        x = int(parts[11])
+        y = int(parts[12])
+    except ValueError:
+        return
+    text = unescape_fig_string(parts[13])
+    fig.texts.append(FigText(x, y, size, text))
+
+    # justification: 0 left, 1 center, 2 right; y is the base line
+    x1 = x - length * justification / 2
+    fig.extend_bbox(x1, y - height, x1 + length, y)
+
+
+class MapGeometry:
+    # Rooms and links of one map section. Coordinates are kept in fig units and
+    # converted to image pixels once the rendered image size is known.
+
+    def __init__(self, fig, magnification):
+        self.resolution = fig.resolution
+        self.scale = magnification * FIG2DEV_PPI / float(fig.resolution)
+        self.bbox = fig.bbox if fig.bbox is not None else Rect(0, 0, 0, 0)
+        self.offset_x = 0.0
+        self.offset_y = 0.0
+        self.rooms = []
+        self.links = []
+
+        cell_size = fig.resolution
+        sizes = [box.width() for box in fig.boxes]
+        if len(sizes) > 0:
+            cell_size = 2 * sum(sizes) / len(sizes)
+        self.room_index = GridIndex(cell_size)
+        self.link_index = GridIndex(cell_size)
+
+        texts = GridIndex(cell_size)
+        for text in fig.texts:
+            texts.insert(Rect(text.x, text.y, text.x, text.y), text)
+
+        for box in fig.boxes:
+            inside = [t for t in texts.query(*box.center()) if box.contains(t.x, t.y)]
+            if len(inside) == 0:
+                continue
+            inside.sort(key=lambda t: t.y)
+            # the room name is written with the largest font, the items below it
+            size = max(t.size for t in inside)
+            name = ' '.join(t.text for t in inside if t.size == size)
+            room = MapRoom(name, box)
+            self.rooms.append(room)
+            self.room_index.insert(box, room)
+
+        margin = self.resolution / 10
+        for points in fig.polylines:
+            link = MapLink(points)
+            link.from_room = self.room_at(points[0][0], points[0][1], margin)
+            link.to_room = self.room_at(points[-1][0], points[-1][1], margin)
+            if link.from_room is None and link.to_room is None:
+                continue
+            self.links.append(link)
+            self.link_index.insert(Rect(link.rect.x1 - margin, link.rect.y1 - margin,
+                                        link.rect.x2 + margin, link.rect.y2 + margin), link)
+
+    def set_image_size(self, width, height):
+        # the remaining space is the border fig2dev puts around the drawing
+        self.offset_x = (width - self.bbox.width() * self.scale) / 2
+        self.offset_y = (height - self.bbox.height() * self.scale) / 2
+
+    def to_image(self, x, y):
+        return (x - self.bbox.x1) * self.scale + self.offset_x, (y - self.bbox.y1) * self.scale + self.offset_y
+
+    def to_fig(self, x, y):
+        return (x - self.offset_x) / self.scale + self.bbox.x1, (y - self.offset_y) / self.scale + self.bbox.y1
+
+    def image_rect(self, rect):
+        x1, y1 = self.to_image(rect.x1, rect.y1)
+        x2, y2 = self.to_image(rect.x2, rect.y2)
+        return Rect(x1, y1, x2, y2)
+
+    def room_at(self, x, y, margin=0):
+        for room in self.room_index.query(x, y):
+            if room.rect.contains(x, y, margin):
+                return room
+        return None
+
+    def link_at(self, x, y):
+        margin = self.resolution / 10
+        best = None
+        best_distance = margin
+        for link in self.link_index.query(x, y):
+            if link.rect.contains(x, y, margin):
+                d = link.distance(x, y)
+                if d <= best_distance:
+                    best = link
+                    best_distance = d
+        return best
+
+    def hit_test(self, image_x, image_y):
+        # returns the room at the given image position, a click on a link selects its target room
+        x, y = self.to_fig(image_x, image_y)
+        room = self.room_at(x, y)
+        if room is not None:
+            return room
+        link = self.link_at(x, y)
+        if link is not None:
+            return link.to_room if link.to_room is not None else link.from_room
+        return None
+
+
+def load_geometry(fig_file, magnification):
+    try:
+        return MapGeometry(parse_fig(fig_file), magnification)
+    except (OSError, ValueError):
+        sys.stderr.write('Could not read the map geometry: \'' + str(fig_file) + '\'\n')
+        traceback.print_exc(file=sys.stderr)
+        return None
+
+
+def find_room_lines(text):
+    # maps the normalized room names to the (1-based) lines of their definitions
+    result = {}
+    for number, line in enumerate(text.split('\n')):
+        code = strip_comment(line)
+        for match in ROOM_PATTERN.finditer(code):
+            result.setdefault(name_key(match.group(1).replace('\\"', '"')), []).append(number + 1)
+    return result
+
+
+def strip_comment(line):
+    if '#' not in line:
+        return line
+    quoted = False
+    escaped = False
+    for i, c in enumerate(line):
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c == '"':
+            quoted = not quoted
+        elif c == '#' and not quoted:
+            return line[:i]
+    return line
+
+
+class SourceIndex:
+    # Links the rooms of all sections to the lines of their definitions and back.
+
+    def __init__(self, text, geometries):
+        room_lines = find_room_lines(text)
+        used = {}
+        entries = []
+        for section, geometry in enumerate(geometries):
+            if geometry is None:
+                continue
+            for room in geometry.rooms:
+                key = name_key(room.name)
+                lines = room_lines.get(key)
+                if lines is None:
+                    continue
+                # rooms with the same name are matched in order of their definitions
+                n = used.get(key, 0)
+                room.line = lines[min(n, len(lines) - 1)]
+                used[key] = n + 1
+                entries.append((room.line, section, room))
+
+        entries.sort(key=lambda e: e[0])
+        self.lines = [e[0] for e in entries]
+        self.entries = entries
+
+    def room_for_line(self, line):
+        # the room whose definition is the last one starting at or before the line
+        i = bisect.bisect_right(self.lines, line) - 1
+        if i < 0:
+            return None, None
+        return self.entries[i][1], self.entries[i][2]
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# The rooms, links, items and map sections of a map, read from the raw output of ifm ('ifm -m -f raw')
+#
+# The raw output is a sequence of records separated by empty lines, each line of a record is a
+# 'key: value' pair and the first key is the kind of the record ('section'/'map', 'room', 'link',
+# 'join' or 'item'). Unknown keys and records are ignored, so other versions of ifm can add fields.
+#
+# Generated games have tens of thousands of rooms, so the model is kept small: the objects have
+# slots instead of a dict, all strings are interned (room names, item names and directions repeat
+# a lot), coordinates are small ints and empty lists are None. Links refer to the room objects.
+# Measured with tracemalloc for 50000 rooms with a link and an item each, the model takes about
+# 560 bytes per room (model_size() counts 480 of them). 'python3 mapmodel.py FILE' measures the
+# model of a map and fails if it takes more than MAX_BYTES_PER_ROOM.
+#
+
+import argparse
+import re
+import sys
+import tracemalloc
+
+from pathlib import Path
+from render import RenderOptions
+
+MAX_BYTES_PER_ROOM = 640
+
+RECORD_SECTION = ('section', 'map')
+RECORD_ROOM = 'room'
+RECORD_LINKS = ('link', 'join')
+RECORD_ITEM = 'item'
+RECORD_SEPARATOR = re.compile(r'\n[ \t\r]*\n')
+
+intern = sys.intern
+
+
+class MapSection:
+    __slots__ = ('number', 'title', 'rooms')
+
+    def __init__(self, number, title=None):
+        self.number = number
+        self.title = title
+        self.rooms = []
+
+
+class MapRoom:
+    __slots__ = ('name', 'tag', 'section', 'x', 'y', 'items')
+
+    def __init__(self, name, tag=None, section=None, x=0, y=0):
+        self.name = name
+        self.tag = tag
+        self.section = section
+        self.x = x
+        self.y = y
+        self.items = None
+
+
+class MapLink:
+    __slots__ = ('from_room', 'to_room', 'go', 'oneway', 'join')
+
+    def __init__(self, from_room, to_room, go=None, oneway=False, join=False):
+        self.from_room = from_room
+        self.to_room = to_room
+        self.go = go
+        self.oneway = oneway
+        self.join = join
+
+
+class MapItem:
+    __slots__ = ('name', 'tag', 'room')
+
+    def __init__(self, name, tag=None, room=None):
+        self.name = name
+        self.tag = tag
+        self.room = room
+
+
+class MapModel:
+
+    def __init__(self):
+        self.sections = []
+        self.rooms = []
+        self.links = []
+        self.items = []
+        self.room_tags = {}
+        self.item_tags = {}
+
+    def room(self, tag):
+        return self.room_tags.get(tag)
+
+    def item(self, tag):
+        return self.item_tags.get(tag)
+
+    def section_rooms(self, number):
+        # the rooms of the map section with the number shown by 'ifm --show=maps', counted from 1
+        if 1 <= number <= len(self.sections):
+            return self.sections[number - 1].rooms
+        return []
+
+    def room_links(self, room):
+        return [link for link in self.links if link.from_room is room or link.to_room is room]
+
+
+def to_int(value, default=None):
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def read_records(text):
+    # yields the records as lists of (key, value), the first pair is the kind of the record
+    for block in RECORD_SEPARATOR.split(text):
+        record = []
+        for line in block.split('\n'):
+            key, separator, value = line.partition(':')
+            if separator:
+                record.append((key.strip(), value.strip()))
+        if len(record) > 0:
+            yield record
+
+
+class ModelBuilder:
+    # Turns the records into a model, references by number are resolved when all rooms are read
+
+    def __init__(self):
+        self.model = MapModel()
+        self.room_ids = {}
+        self.section_numbers = {}
+        self.pending_links = []
+        self.pending_items = []
+
+    def add(self, record):
+        kind = record[0][0]
+        if kind in RECORD_SECTION:
+            self.add_section(record)
+        elif kind == RECORD_ROOM:
+            self.add_room(record)
+        elif kind in RECORD_LINKS:
+            self.add_link(record, kind == 'join')
+        elif kind == RECORD_ITEM:
+            self.add_item(record)
+
+    def section(self, number):
+        section = self.section_numbers.get(number)
+        if section is None:
+            section = MapSection(number)
+            self.section_numbers[number] = section
+        return section
+
+    def add_section(self, record):
+        section = self.section(to_int(record[0][1], len(self.section_numbers) + 1))
+        for key, value in record[1:]:
+            if key in ('title', 'name'):
+                section.title = intern(value)
+
+    def add_room(self, record):
+        room = MapRoom('')
+        room_id = to_int(record[0][1])
+        section = None
+        for key, value in record[1:]:
+            if key == 'name':
+                room.name = intern(value)
+            elif key == 'tag':
+                room.tag = intern(value)
+            elif key in RECORD_SECTION:
+                section = to_int(value)
+            elif key == 'pos':
+                position = value.split()
+                if len(position) >= 2:
+                    room.x = to_int(position[0], 0)
+                    room.y = to_int(position[1], 0)
+            elif key == 'x':
+                room.x = to_int(value, 0)
+            elif key == 'y':
+                room.y = to_int(value, 0)
+
+        if room_id is not None:
+            self.room_ids[room_id] = room
+        if room.tag is not None:
+            self.model.room_tags[room.tag] = room
+        if section is not None:
+            room.section = self.section(section)
+            room.section.rooms.append(room)
+        self.model.rooms.append(room)
+
+    def add_link(self, record, join):
+        # 'link: <from> <to>' or the numbers in 'from' and 'to' fields
+        ends = record[0][1].split()
+        link = MapLink(None, None, join=join)
+        from_id = to_int(ends[0]) if len(ends) >= 2 else None
+        to_id = to_int(ends[1]) if len(ends) >= 2 else None
+        for key, value in record[1:]:
+            if key == 'from':
+                from_id = to_int(value)
+            elif key == 'to':
+                to_id = to_int(value)
+            elif key == 'go':
+                link.go = intern(value)
+            elif key == 'oneway':
+                link.oneway = value not in ('', '0', 'false', 'no')
+        self.pending_links.append((link, from_id, to_id))
+
+    def add_item(self, record):
+        item = MapItem('')
+        room_id = None
+        for key, value in record[1:]:
+            if key == 'name':
+                item.name = intern(value)
+            elif key == 'tag':
+                item.tag = intern(value)
+            elif key == 'room':
+                room_id = to_int(value)
+        if item.tag is not None:
+            self.model.item_tags[item.tag] = item
+        self.pending_items.append((item, room_id))
+
+    def finish(self):
+        model = self.model
+        for link, from_id, to_id in self.pending_links:
+            link.from_room = self.room_ids.get(from_id)
+            link.to_room = self.room_ids.get(to_id)
+            if link.from_room is not None and link.to_room is not None:
+                model.links.append(link)
+
+        for item, room_id in self.pending_items:
+            item.room = self.room_ids.get(room_id)
+            if item.room is not None:
+                # mostly a single item, a tuple is smaller than a list
+                item.room.items = (item,) if item.room.items is None else item.room.items + (item,)
+            model.items.append(item)
+
+        model.sections = [self.section_numbers[number] for number in sorted(self.section_numbers)]
+        for section in model.sections:
+            section.rooms.sort(key=lambda room: (room.y, room.x))
+
+        self.room_ids = self.section_numbers = None
+        self.pending_links = self.pending_items = None
+        return model
+
+
+def parse_raw(text):
+    builder = ModelBuilder()
+    for record in read_records(text):
+        builder.add(record)
+    return builder.finish()
+
+
+def load_model(raw):
+    # the model of the raw output kept with a render result, None if it can't be read
+    try:
+        with open(str(raw), 'r', encoding='utf-8') as file:
+            return parse_raw(file.read())
+    except (OSError, ValueError):
+        return None
+
+
+def model_size(model):
+    # the bytes taken by the objects of the model, the interned strings are counted once
+    seen = set()
+    size = 0
+    objects = [model, model.sections, model.rooms, model.links, model.items, model.room_tags, model.item_tags]
+    objects += model.sections + model.rooms + model.links + model.items
+    objects += [section.rooms for section in model.sections]
+    objects += [room.items for room in model.rooms if room.items is not None]
+    for obj in model.rooms:
+        objects += (obj.name, obj.tag, obj.x, obj.y)
+    for obj in model.items:
+        objects += (obj.name, obj.tag)
+    for obj in model.links:
+        objects.append(obj.go)
+    for obj in objects:
+        if obj is not None and id(obj) not in seen:
+            seen.add(id(obj))
+            size += sys.getsizeof(obj)
+    return size
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Measures the memory taken by the map model of an IFM file')
+    parser.add_argument('file', type=Path, help='the IFM file')
+    parser.add_argument('--ifm', default='ifm', help='the ifm command')
+    args = parser.parse_args(argv[1:])
+
+    options = RenderOptions(ifm_command=args.ifm)
+    file = args.file.resolve()
+    result = options.runner().run(options.ifm_raw_argv(file), cwd=file.parent)
+    if not result.ok():
+        sys.stderr.write(result.output + '\n')
+        return 1
+
+    tracemalloc.start()
+    model = parse_raw(result.stdout)
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    rooms = max(1, len(model.rooms))
+    print('{} rooms, {} links, {} items, {} sections'.format(len(model.rooms), len(model.links), len(model.items),
+                                                          len(model.sections)))
+    print('{} bytes per room (traced), {} bytes per room (model_size), bound {}'.format(
+        traced // rooms, model_size(model) // rooms, MAX_BYTES_PER_ROOM))
+    return 0 if traced // rooms <= MAX_BYTES_PER_ROOM else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
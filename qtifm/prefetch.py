@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Rendering the recent files in the background, so their maps are in the render cache when opened
+#
+
+import constants as const
+import ifmparser
+import render
+import tasks
+
+from PyQt5.QtCore import QObject, QThreadPool, QTimer
+
+PREFETCH_NICE = 19
+# the renders run for CPU_SHARE of every THROTTLE_PERIOD (ms) and are stopped for the rest
+CPU_SHARE = 0.5
+THROTTLE_PERIOD = 200
+
+
+def prefetch_files(options, files, runner, client=None):
+    # Renders the files whose current content isn't in the render cache, returns the number rendered.
+    # The render daemon renders them if the client finds it, so its limit of renders applies.
+    cache = render.RenderCache()
+    rendered = 0
+    for file in files:
+        if runner.cancelled:
+            break
+        try:
+            key = render.file_render_key(options, file)
+        except OSError:
+            continue
+        if cache.contains(key) or not valid_file(file):
+            continue
+        result = client.render(options, file, PREFETCH_NICE) if client is not None else None
+        if result is None:
+            result = render.render_file(options, file, cache, runner)
+        if result.ok():
+            rendered += 1
+    return rendered
+
+
+def valid_file(file):
+    try:
+        with open(str(file), 'r', encoding='utf-8') as source:
+            return ifmparser.parse(source.read()).valid()
+    except (OSError, ValueError):
+        return False
+
+
+class RecentFilesPrefetcher(QObject):
+    # Renders the recent files once the user has been idle for PREFETCH_IDLE_DELAY. The renders run
+    # one at a time with the lowest priority and are throttled to CPU_SHARE by stopping and continuing
+    # the processes. Any activity (typing, an interactive render) stops them at once, they continue
+    # after the next idle delay. Renders by the render daemon only run with the lowest priority.
+
+    def __init__(self, config, parent=None):
+        QObject.__init__(self, parent)
+        self.config = config
+        self.runner = None
+        self.client = None
+        self.paused = False
+        self.throttled = False
+
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(const.PREFETCH_IDLE_DELAY)
+        self.idle_timer.timeout.connect(self.idle)
+
+        self.throttle_timer = QTimer(self)
+        self.throttle_timer.setSingleShot(True)
+        self.throttle_timer.timeout.connect(self.throttle)
+
+    def start(self):
+        self.idle_timer.start()
+
+    def activity(self):
+        self.idle_timer.start()
+        if self.runner is not None and not self.paused:
+            self.paused = True
+            self.runner.pause()
+
+    def idle(self):
+        if self.runner is not None:
+            if self.paused:
+                self.paused = False
+                self.throttled = False
+                self.runner.resume()
+                self.throttle_timer.start(int(THROTTLE_PERIOD * CPU_SHARE))
+            return
+
+        files = [file for file in self.config.editor_recent_files if file.is_file()]
+        if not self.config.map_prefetch_recent_files or len(files) == 0:
+            return
+        options = render.RenderOptions.from_config(self.config)
+        self.runner = options.runner(nice=PREFETCH_NICE)
+        self.client = render.RenderClient() if self.config.map_use_render_daemon else None
+        self.paused = False
+        self.throttled = False
+        runner = self.runner
+        tasks.start_task(prefetch_files, options, files, runner, self.client, pool=self.pool,
+                         finished=lambda rendered: self.finished(runner),
+                         failed=lambda error: self.finished(runner))
+        self.throttle_timer.start(int(THROTTLE_PERIOD * CPU_SHARE))
+
+    def throttle(self):
+        if self.runner is None or self.paused:
+            return
+        self.throttled = not self.throttled
+        if self.throttled:
+            self.runner.pause()
+            self.throttle_timer.start(int(THROTTLE_PERIOD * (1 - CPU_SHARE)))
+        else:
+            self.runner.resume()
+            self.throttle_timer.start(int(THROTTLE_PERIOD * CPU_SHARE))
+
+    def finished(self, runner):
+        if runner is self.runner:
+            self.runner = None
+            self.client = None
+            self.throttle_timer.stop()
+
+    def stop(self):
+        self.idle_timer.stop()
+        self.throttle_timer.stop()
+        if self.runner is not None:
+            self.runner.cancel()
+            self.runner.resume()
+            self.runner = None
+        if self.client is not None:
+            self.client.cancel()
+            self.client = None
+        self.pool.waitForDone()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Running the external programs (ifm, fig2dev)
+#
+
+import os
+import signal
+import subprocess
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+# the wall-clock timeout is checked in slices of this length (s), to leave out the time paused
+TIMEOUT_SLICE = 0.5
+
+
+def command_argv(command):
+    # the configured commands are paths of the programs chosen in the settings, spaces and quotes
+    # are part of the path
+    return [command]
+
+
+class ProcessResult:
+
+    def __init__(self, returncode, stdout='', stderr='', timed_out=False, cancelled=False):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out and not self.cancelled
+
+    @property
+    def output(self):
+        # stdout and stderr combined, for error messages
+        parts = [part.rstrip('\n') for part in (self.stdout, self.stderr) if len(part) > 0]
+        return '\n'.join(parts)
+
+
+class ProcessRunner:
+    # Runs programs from argv lists without a shell. Every call gets a wall-clock timeout and
+    # optional CPU time (seconds) and address space (MB) limits. The runner is thread-safe;
+    # cancel() kills all running processes and makes further calls return immediately. pause()
+    # stops the running processes and holds back new ones until resume().
+
+    def __init__(self, timeout=None, cpu_limit=None, memory_limit=None, nice=0):
+        self.timeout = timeout if timeout else None
+        self.cpu_limit = cpu_limit if cpu_limit else None
+        self.memory_limit = memory_limit if memory_limit else None
+        self.nice = nice
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.paused = False
+        self.running = threading.Event()
+        self.running.set()
+
+    @classmethod
+    def from_config(cls, config, nice=0):
+        return cls(config.map_process_timeout, config.map_process_cpu_limit, config.map_process_memory_limit, nice)
+
+    def run(self, argv, cwd=None):
+        self.running.wait()
+        with self.lock:
+            if self.cancelled:
+                return ProcessResult(-1, cancelled=True)
+            argv = [str(arg) for arg in argv]
+            try:
+                process = subprocess.Popen(self.__limit_argv(argv), stdin=subprocess.DEVNULL,
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                           cwd=None if cwd is None else str(cwd),
+                                           start_new_session=os.name == 'posix')
+            except OSError as e:
+                return ProcessResult(127, stderr=argv[0] + ': ' + e.strerror)
+            self.__limits(process)
+            self.processes.add(process)
+            if self.paused:
+                self.__send(process, signal.SIGSTOP)  # paused while it was started
+
+        timed_out = False
+        try:
+            try:
+                stdout, stderr = self.__communicate(process)
+            except subprocess.TimeoutExpired:
+                timed_out = True
+                self.__kill(process)
+                stdout, stderr = process.communicate()
+        finally:
+            with self.lock:
+                self.processes.discard(process)
+
+        return ProcessResult(process.returncode, stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace'),
+                             timed_out=timed_out, cancelled=self.cancelled)
+
+    def __communicate(self, process):
+        # the time the process was paused doesn't count against the timeout
+        if self.timeout is None:
+            return process.communicate()
+        remaining = self.timeout
+        while True:
+            started = time.monotonic()
+            paused = self.paused
+            try:
+                return process.communicate(timeout=min(remaining, TIMEOUT_SLICE))
+            except subprocess.TimeoutExpired:
+                if not paused and not self.paused:
+                    remaining -= time.monotonic() - started
+                if remaining <= 0:
+                    raise
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for process in self.processes:
+                self.__kill(process)
+        self.running.set()
+
+    def pause(self):
+        with self.lock:
+            self.paused = True
+            self.running.clear()
+        self.__signal(signal.SIGSTOP)
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+            self.running.set()
+        self.__signal(signal.SIGCONT)
+
+    def __signal(self, sig):
+        with self.lock:
+            for process in self.processes:
+                self.__send(process, sig)
+
+    @staticmethod
+    def __send(process, sig):
+        try:
+            os.killpg(process.pid, sig)
+        except OSError:
+            pass
+
+    @staticmethod
+    def __kill(process):
+        try:
+            if os.name == 'posix':
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError:
+            pass
+
+    # The limits are applied to the started process, not between fork and exec (preexec_fn isn't
+    # safe with the threads running processes here). Without prlimit (only on linux) the program
+    # is started by a shell setting the limits.
+
+    def __limit_argv(self, argv):
+        if resource is None or hasattr(resource, 'prlimit') or os.name != 'posix':
+            return argv
+        commands = []
+        if self.cpu_limit is not None:
+            commands.append('ulimit -S -t ' + str(self.cpu_limit))
+        if self.memory_limit is not None:
+            commands.append('ulimit -S -v ' + str(self.memory_limit * 1024))
+        if len(commands) == 0:
+            return argv
+        return ['/bin/sh', '-c', ' && '.join(commands) + ' && exec "$@"', 'sh'] + argv
+
+    def __limits(self, process):
+        try:
+            if self.nice and hasattr(os, 'setpriority'):
+                priority = os.getpriority(os.PRIO_PROCESS, process.pid)
+                os.setpriority(os.PRIO_PROCESS, process.pid, min(19, priority + self.nice))
+            if resource is None or not hasattr(resource, 'prlimit'):
+                return
+            if self.cpu_limit is not None:
+                set_limit(process.pid, resource.RLIMIT_CPU, self.cpu_limit)
+            if self.memory_limit is not None:
+                set_limit(process.pid, resource.RLIMIT_AS, self.memory_limit * 1024 * 1024)
+        except OSError:
+            pass  # the process has finished already
+
+
+def set_limit(pid, kind, limit):
+    # never raise the hard limit, that would fail for unprivileged users
+    soft, hard = resource.prlimit(pid, kind)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.prlimit(pid, kind, (limit, hard))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# The search index of all IFM files below a project directory
+#
+
+import hashlib
+import json
+import os
+import sys
+import traceback
+
+from config import cache_path
+from pathlib import Path
+
+INDEX_VERSION = 1
+MAX_RESULTS = 2000
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(0, len(text) - 2)}
+
+
+class SearchResult:
+
+    def __init__(self, path, line, text):
+        self.path = path
+        self.line = line
+        self.text = text
+
+
+class ProjectIndex:
+    # A trigram index: for every file the set of its (lower case) three character substrings is kept,
+    # and for every trigram the files containing it. A query only reads the files containing all
+    # trigrams of the search text. The index is stored in the cache directory and updated from the
+    # modification times and sizes of the files.
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.files = {}
+        self.postings = {}
+        self.modified = False
+
+    def index_file(self):
+        name = hashlib.sha1(str(self.root.absolute()).encode('utf-8')).hexdigest()
+        return cache_path().joinpath('projects', name + '.json')
+
+    def load(self):
+        path = self.index_file()
+        if not path.exists():
+            return
+        try:
+            with open(str(path), 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            sys.stderr.write('Could not read the project index: \'' + str(path) + '\'\n')
+            traceback.print_exc(file=sys.stderr)
+            return
+        if data.get('version') != INDEX_VERSION:
+            return
+
+        for name, entry in data.get('files', {}).items():
+            grams = entry[2]
+            self.add(name, entry[0], entry[1], {grams[i:i + 3] for i in range(0, len(grams), 3)})
+
+    def save(self):
+        if not self.modified:
+            return
+        path = self.index_file()
+        files = {}
+        for name, entry in self.files.items():
+            files[name] = [entry[0], entry[1], ''.join(sorted(entry[2]))]
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp = path.with_suffix('.tmp')
+            with open(str(temp), 'w', encoding='utf-8') as file:
+                json.dump({'version': INDEX_VERSION, 'root': str(self.root), 'files': files}, file)
+            os.replace(str(temp), str(path))
+            self.modified = False
+        except OSError:
+            sys.stderr.write('Could not write the project index: \'' + str(path) + '\'\n')
+            traceback.print_exc(file=sys.stderr)
+
+    def add(self, name, mtime, size, grams):
+        self.files[name] = [mtime, size, grams]
+        for gram in grams:
+            files = self.postings.get(gram)
+            if files is None:
+                self.postings[gram] = {name}
+            else:
+                files.add(name)
+
+    def remove(self, name):
+        for gram in self.files[name][2]:
+            files = self.postings[gram]
+            files.discard(name)
+            if len(files) == 0:
+                del self.postings[gram]
+        del self.files[name]
+
+    def update(self):
+        # re-indexes the new and changed files, returns the number of changes
+        found = set()
+        changes = 0
+        for directory, dirs, names in os.walk(str(self.root)):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for filename in names:
+                if not filename.lower().endswith('.ifm'):
+                    continue
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, str(self.root))
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.add(name)
+                entry = self.files.get(name)
+                if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                    continue
+                try:
+                    with open(path, 'r', encoding='utf-8', errors='replace') as file:
+                        grams = trigrams(file.read().lower())
+                except OSError:
+                    continue
+                if entry is not None:
+                    self.remove(name)
+                self.add(name, stat.st_mtime_ns, stat.st_size, grams)
+                changes += 1
+
+        for name in [n for n in self.files if n not in found]:
+            self.remove(name)
+            changes += 1
+
+        if changes > 0:
+            self.modified = True
+        return changes
+
+    def candidates(self, query):
+        grams = trigrams(query)
+        if len(grams) == 0:
+            return sorted(self.files)
+        postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+        result = set(postings[0])
+        for files in postings[1:]:
+            result &= files
+            if len(result) == 0:
+                break
+        return sorted(result)
+
+    def search(self, text, limit=MAX_RESULTS):
+        query = text.lower()
+        results = []
+        if len(query) == 0:
+            return results
+        for name in self.candidates(query):
+            path = self.root.joinpath(name)
+            try:
+                with open(str(path), 'r', encoding='utf-8', errors='replace') as file:
+                    for number, line in enumerate(file):
+                        if query in line.lower():
+                            results.append(SearchResult(path, number + 1, line.rstrip('\n')))
+                            if len(results) >= limit:
+                                return results
+            except OSError:
+                continue
+        return results
+
+
+def search_project(index, text):
+    # runs on a worker thread: brings the index up to date, then searches
+    if len(index.files) == 0:
+        index.load()
+    index.update()
+    index.save()
+    return index.search(text)
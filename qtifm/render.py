@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Rendering of the map images with ifm and fig2dev, the shared render cache and the render daemon client
+#
+
+import hashlib
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import traceback
+
+from config import cache_path
+from pathlib import Path
+from process import ProcessRunner, command_argv
+
+RENDER_STATUS_OK = 'ok'
+RENDER_STATUS_SYNTAX = 'syntax'
+RENDER_STATUS_IFM = 'ifm'
+RENDER_STATUS_FIG2DEV = 'fig2dev'
+RENDER_STATUS_TIMEOUT = 'timeout'
+RENDER_STATUS_CANCELLED = 'cancelled'
+# ifm or fig2dev couldn't be started or were killed, e.g. by a resource limit
+RENDER_STATUS_FAILED = 'failed'
+
+CACHE_ENTRIES = 200
+# part of the render keys, entries of older versions lack files of the newer ones (2: the raw output)
+CACHE_VERSION = 2
+
+# the formats for the images shown in qtIFM: ppm isn't compressed, so fig2dev writes it and qtIFM reads it faster
+PREVIEW_FORMATS = ['png', 'ppm']
+CONNECT_TIMEOUT = 2.0
+# the time the daemon may take to answer without a process timeout, it waits for other renders first
+DAEMON_WAIT = 30.0
+
+
+def fig2dev_magnification(factor):
+    if factor is not None and 0 < factor < 10:
+        return float(factor + 1) / 2
+    return 2.0
+
+
+def render_socket_path():
+    runtime = os.environ.get('XDG_RUNTIME_DIR', '')
+    if len(runtime) > 0:
+        return Path(runtime).joinpath('qtifm-renderd.sock')
+    return cache_path().joinpath('renderd.sock')
+
+
+class RenderOptions:
+
+    def __init__(self, ifm_command='ifm', fig2dev_command='fig2dev', helvetica=False, image_per_map=True,
+                 magnification_factor=3, timeout=None, cpu_limit=None, memory_limit=None, image_format='png'):
+        self.ifm_command = ifm_command
+        self.fig2dev_command = fig2dev_command
+        self.helvetica = helvetica
+        self.image_per_map = image_per_map
+        self.magnification_factor = magnification_factor
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        self.image_format = image_format if image_format in PREVIEW_FORMATS else 'png'
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.map_ifm_command, config.map_fig2dev_command, config.map_ifm_helvetica_as_default,
+                   config.map_ifm_create_image_per_map, config.map_fig2dev_magnification_factor,
+                   config.map_process_timeout, config.map_process_cpu_limit, config.map_process_memory_limit,
+                   config.map_preview_format)
+
+    @classmethod
+    def from_dict(cls, data):
+        options = cls()
+        for name in options.__dict__:
+            if name in data:
+                setattr(options, name, data[name])
+        if options.image_format not in PREVIEW_FORMATS:
+            options.image_format = 'png'
+        return options
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def magnification(self):
+        return fig2dev_magnification(self.magnification_factor)
+
+    def runner(self, nice=0):
+        return ProcessRunner(self.timeout, self.cpu_limit, self.memory_limit, nice)
+
+    def ifm_fig_argv(self, file, section, fig):
+        argv = command_argv(self.ifm_command)
+        if self.helvetica:
+            argv += ['-S', 'helvetica']
+        argv += ['-m=' + section if section is not None else '-m', '-f', 'fig', '-o', str(fig), str(file)]
+        return argv
+
+    def ifm_raw_argv(self, file):
+        return command_argv(self.ifm_command) + ['-m', '-f', 'raw', str(file)]
+
+    def fig2dev_argv(self, language, options, fig, target):
+        return command_argv(self.fig2dev_command) + ['-L', language, '-m', str(self.magnification())] + \
+               options + [str(fig), str(target)]
+
+
+class RenderSection:
+
+    def __init__(self, section, name, fig, image):
+        self.section = section
+        self.name = name
+        self.fig = fig
+        self.image = image
+
+
+class RenderResult:
+
+    def __init__(self, status, output='', sections=None, key=None, raw=None):
+        self.status = status
+        self.output = output
+        self.sections = sections if sections is not None else []
+        self.key = key
+        self.raw = raw  # the output of 'ifm -m -f raw' for the map model, None if ifm failed to write it
+
+    def ok(self):
+        return self.status == RENDER_STATUS_OK
+
+    def cacheable(self):
+        # only results depending on the content of the file alone
+        return self.status in (RENDER_STATUS_OK, RENDER_STATUS_SYNTAX)
+
+    @classmethod
+    def from_dict(cls, data):
+        sections = [RenderSection(s[0], s[1], Path(s[2]), Path(s[3])) for s in data.get('sections', [])]
+        raw = data.get('raw')
+        return cls(data.get('status', RENDER_STATUS_IFM), data.get('output', ''), sections, data.get('key'),
+                   Path(raw) if raw is not None else None)
+
+    def to_dict(self):
+        return {
+            'status': self.status,
+            'output': self.output,
+            'sections': [[s.section, s.name, str(s.fig), str(s.image)] for s in self.sections],
+            'key': self.key,
+            'raw': str(self.raw) if self.raw is not None else None,
+        }
+
+    def relocate(self, old, new):
+        for s in self.sections:
+            s.fig = new.joinpath(s.fig.relative_to(old))
+            s.image = new.joinpath(s.image.relative_to(old))
+        if self.raw is not None:
+            self.raw = new.joinpath(self.raw.relative_to(old))
+
+
+def render_key(options, file, data):
+    # everything that changes the rendered images: the content, the location (for error messages)
+    # and the options that are passed to ifm and fig2dev
+    digest = hashlib.sha1()
+    digest.update(str(file).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(json.dumps([CACHE_VERSION, options.ifm_command, options.fig2dev_command, options.helvetica,
+                              options.image_per_map, options.magnification_factor,
+                              options.image_format]).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def file_render_key(options, file):
+    with open(str(file), 'rb') as source:
+        return render_key(options, file, source.read())
+
+
+class RenderCache:
+    # One directory per render key holding the fig and image files and a result.json. Entries are
+    # created in a temporary directory and renamed into place, so several processes can share the cache.
+
+    def __init__(self, root=None):
+        self.root = root if root is not None else cache_path().joinpath('renders')
+
+    def entry(self, key):
+        return self.root.joinpath(key)
+
+    def lookup(self, key):
+        manifest = self.entry(key).joinpath('result.json')
+        try:
+            with open(str(manifest), 'r', encoding='utf-8') as file:
+                result = RenderResult.from_dict(json.load(file))
+            os.utime(str(manifest))
+        except (OSError, ValueError):
+            return None
+        if not all(s.image.exists() for s in result.sections):
+            return None
+        return result
+
+    def contains(self, key):
+        return self.entry(key).joinpath('result.json').exists()
+
+    def create_work_dir(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        return Path(tempfile.mkdtemp(prefix='tmp-', dir=str(self.root)))
+
+    def store(self, key, work_dir, result):
+        target = self.entry(key)
+        result.relocate(work_dir, target)
+        with open(str(work_dir.joinpath('result.json')), 'w', encoding='utf-8') as file:
+            json.dump(result.to_dict(), file)
+        try:
+            os.rename(str(work_dir), str(target))
+        except OSError:
+            # another process stored the same render meanwhile
+            shutil.rmtree(str(work_dir), ignore_errors=True)
+            cached = self.lookup(key)
+            if cached is not None:
+                return cached
+        self.evict()
+        return result
+
+    def evict(self, keep=CACHE_ENTRIES):
+        try:
+            entries = [e for e in self.root.iterdir() if e.is_dir() and not e.name.startswith('tmp-')]
+        except OSError:
+            return
+        if len(entries) <= keep:
+            return
+        entries.sort(key=lambda e: entry_time(e))
+        for entry in entries[:len(entries) - keep]:
+            shutil.rmtree(str(entry), ignore_errors=True)
+
+
+def entry_time(entry):
+    try:
+        return entry.joinpath('result.json').stat().st_mtime
+    except OSError:
+        return 0
+
+
+def process_status(result, status):
+    if result.timed_out:
+        return RENDER_STATUS_TIMEOUT
+    if result.cancelled:
+        return RENDER_STATUS_CANCELLED
+    if result.returncode < 0 or result.returncode in (126, 127):
+        return RENDER_STATUS_FAILED  # killed by a signal, or not executable
+    return status
+
+
+def render_file(options, file, cache=None, runner=None):
+    # renders all map sections of the file, or returns the cached result of an earlier render
+    cache = cache if cache is not None else RenderCache()
+    try:
+        key = file_render_key(options, file)
+    except OSError as e:
+        return RenderResult(RENDER_STATUS_IFM, str(file) + ': ' + e.strerror)
+
+    cached = cache.lookup(key)
+    if cached is not None:
+        return cached
+
+    runner = runner if runner is not None else options.runner()
+    work_dir = cache.create_work_dir()
+    try:
+        result = render_sections(options, file, work_dir, runner)
+        result.key = key
+        if result.cacheable():
+            return cache.store(key, work_dir, result)
+        shutil.rmtree(str(work_dir), ignore_errors=True)
+        return result
+    except Exception:
+        shutil.rmtree(str(work_dir), ignore_errors=True)
+        raise
+
+
+def render_sections(options, file, work_dir, runner):
+    base = file.parent
+    ifm = command_argv(options.ifm_command)
+
+    # check syntax
+    result = runner.run(ifm + [file], cwd=base)
+    if not result.ok():
+        return RenderResult(process_status(result, RENDER_STATUS_SYNTAX), result.output)
+    warnings = result.stderr  # kept with the result, also in the cache, for the editor
+
+    # check maps
+    sections = []
+    if options.image_per_map:
+        result = runner.run(ifm + ['--show=maps', file], cwd=base)
+        if not result.ok():
+            return RenderResult(process_status(result, RENDER_STATUS_SYNTAX), result.output)
+        sections = parse_sections(result.stdout)
+
+    if len(sections) == 0:
+        sections = [[None, None]]
+
+    rendered = []
+    for section, name in sections:
+        stem = 'map' if section is None else 'map_' + section
+        fig = work_dir.joinpath(stem + '.fig')
+        image = work_dir.joinpath(stem + '.' + options.image_format)
+
+        # create fig files
+        result = runner.run(options.ifm_fig_argv(file, section, fig), cwd=base)
+        if not result.ok():
+            return RenderResult(process_status(result, RENDER_STATUS_IFM), result.output)
+
+        # create image files
+        result = runner.run(options.fig2dev_argv(options.image_format, ['-S', '4', '-b', '5'], fig, image), cwd=base)
+        if not result.ok():
+            return RenderResult(process_status(result, RENDER_STATUS_FIG2DEV), result.output)
+
+        rendered.append(RenderSection(section, name, fig, image))
+
+    # the rooms, links and items for the map model, kept with the images
+    raw = work_dir.joinpath('map.raw')
+    result = runner.run(options.ifm_raw_argv(file), cwd=base)
+    status = process_status(result, RENDER_STATUS_OK)
+    if status != RENDER_STATUS_OK:
+        return RenderResult(status, result.output)  # not cached, the next render tries again
+    if result.ok():
+        with open(str(raw), 'w', encoding='utf-8') as output:
+            output.write(result.stdout)
+    else:
+        raw = None  # the images are fine without the model
+
+    return RenderResult(RENDER_STATUS_OK, warnings, sections=rendered, raw=raw)
+
+
+def parse_sections(output):
+    sections = []
+    lines = output.rstrip('\n').split('\n')
+    if len(lines) > 1:
+        header = False
+        for line in lines:
+            if header:
+                fields = line.split('\t')
+                if len(fields) == 5:
+                    sections.append([fields[0], fields[4]])
+            else:
+                header = line.startswith('No.')
+    return sections
+
+
+class RenderClient:
+    # Talks to the render daemon (renderd.py). render() returns None if there is no daemon,
+    # the caller renders in-process then. cancel() makes a waiting render() return None at once.
+
+    def __init__(self, path=None):
+        self.path = path if path is not None else render_socket_path()
+        self.connection = None
+        self.cancelled = False
+
+    def render(self, options, file, nice=0):
+        # the processes of the daemon run with the given nice value
+        if self.cancelled or not self.path.exists():
+            return None
+
+        request = json.dumps({'file': str(Path(file).absolute()), 'options': options.to_dict(),
+                              'nice': nice}) + '\n'
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                self.connection = connection
+                if self.cancelled:
+                    return None
+                # the daemon applies the process timeouts, but may be busy with the renders of
+                # other instances; when it doesn't answer in time the file is rendered in-process
+                connection.settimeout(CONNECT_TIMEOUT)
+                connection.connect(str(self.path))
+                connection.settimeout(CONNECT_TIMEOUT + (options.timeout if options.timeout else DAEMON_WAIT))
+                connection.sendall(request.encode('utf-8'))
+                with connection.makefile('r', encoding='utf-8') as reader:
+                    line = reader.readline()
+        except OSError:
+            return None
+        finally:
+            self.connection = None
+
+        if len(line) == 0:
+            return None  # cancelled, or the daemon was stopped
+        try:
+            return RenderResult.from_dict(json.loads(line))
+        except ValueError:
+            sys.stderr.write('Invalid answer from the render daemon: \'' + line + '\'\n')
+            traceback.print_exc(file=sys.stderr)
+            return None
+
+    def cancel(self):
+        # called from another thread
+        self.cancelled = True
+        connection = self.connection
+        if connection is not None:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
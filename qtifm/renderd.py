@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# The render daemon: renders maps for all qtIFM instances on this machine.
+#
+# Clients send one JSON line {"file": ..., "options": {...}} over a unix domain socket and get the
+# render result as one JSON line back. Identical requests in flight are rendered only once, and
+# at most --jobs renders run at the same time.
+#
+
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+import render
+
+from pathlib import Path
+
+
+class PendingRender:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class RenderService:
+
+    def __init__(self, jobs, cache):
+        self.cache = cache
+        self.slots = threading.BoundedSemaphore(jobs)
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def render(self, options, file, nice=0):
+        try:
+            key = render.file_render_key(options, file)
+        except OSError as e:
+            return render.RenderResult(render.RENDER_STATUS_IFM, str(file) + ': ' + e.strerror)
+
+        cached = self.cache.lookup(key)
+        if cached is not None:
+            return cached
+
+        with self.lock:
+            pending = self.pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = PendingRender()
+                self.pending[key] = pending
+
+        if not owner:
+            pending.done.wait()
+            return pending.result
+
+        try:
+            with self.slots:
+                pending.result = render.render_file(options, file, self.cache, options.runner(nice))
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            pending.result = render.RenderResult(render.RENDER_STATUS_IFM, str(e))
+        finally:
+            with self.lock:
+                del self.pending[key]
+            pending.done.set()
+        return pending.result
+
+
+class RenderRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline().decode('utf-8')
+        if len(line) == 0:
+            return  # just a check whether the daemon is running
+        try:
+            request = json.loads(line)
+            options = render.RenderOptions.from_dict(request['options'])
+            file = Path(request['file'])
+            nice = max(0, min(19, int(request.get('nice', 0))))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            result = render.RenderResult(render.RENDER_STATUS_IFM, 'Invalid request: ' + line)
+        else:
+            result = self.server.service.render(options, file, nice)
+        self.wfile.write((json.dumps(result.to_dict()) + '\n').encode('utf-8'))
+
+
+class RenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        self.service = service
+        socketserver.UnixStreamServer.__init__(self, str(path), RenderRequestHandler)
+
+
+def socket_in_use(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(str(path))
+            return True
+        except OSError:
+            return False
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='qtIFM render daemon')
+    parser.add_argument('--socket', type=Path, default=render.render_socket_path(),
+                        help='the unix domain socket to listen on')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='the maximum number of renders running at the same time')
+    args = parser.parse_args(argv[1:])
+
+    path = args.socket
+    if path.exists():
+        if socket_in_use(path):
+            sys.stderr.write('The render daemon is already running: \'' + str(path) + '\'\n')
+            return 1
+        path.unlink()
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    server = RenderServer(path, RenderService(max(1, args.jobs), render.RenderCache()))
+    os.chmod(str(path), 0o600)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        path.unlink()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Replays a session recorded with "main.py --record FILE" in a main window without display and
+# reports the latencies per interaction:
+#   edit  the edit until the editor is repainted, with the syntax highlighting
+#   open  opening the file until the first map tab shows its image
+#   save  saving the file until the first map tab shows its image
+#   tab   selecting a map tab until it's repainted
+#   zoom  a zoom action until the map is repainted
+#
+# The files are written to a temporary directory, a new one for every repetition, so the maps are
+# rendered again each time unless the content is in the render cache under that name already. The
+# home, cache and runtime directories are temporary as well, so the configuration, render cache,
+# recovery journals and render daemon of the user aren't used.
+#
+
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+import gui
+import session
+import tasks
+
+from pathlib import Path
+from PyQt5.QtCore import QEvent, QObject
+from PyQt5.QtGui import QTextCursor
+from PyQt5.QtWidgets import QApplication
+
+PERCENTILES = [50, 90, 99]
+PAINT_TIMEOUT = 2.0  # s
+RENDER_TIMEOUT = 300.0  # s
+
+
+def percentile(values, p):
+    # nearest rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100.0 * len(ordered)) - 1)]
+
+
+class PaintWatcher(QObject):
+    # notes the time of the first paint event of a widget after arm()
+
+    def __init__(self):
+        QObject.__init__(self)
+        self.widget = None
+        self.painted = None
+
+    def arm(self, widget):
+        if self.widget is not None:
+            self.widget.removeEventFilter(self)
+        self.widget = widget
+        self.painted = None
+        widget.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint and self.painted is None:
+            self.painted = time.perf_counter()
+        return False
+
+
+class SessionReplayer:
+
+    def __init__(self, app, main_window, realtime=False):
+        self.app = app
+        self.main_window = main_window
+        self.editor = main_window.editor
+        self.map_view = main_window.map_view
+        self.realtime = realtime
+        self.directory = None
+        self.latencies = {}
+        self.skipped = 0
+        self.watcher = PaintWatcher()
+        self.maps_changed = False
+        # connected after the main window, so the maps are created when this is called
+        self.editor.map_changed_signal.connect(self.map_changed)
+
+    def map_changed(self):
+        self.maps_changed = True
+
+    def wait(self, condition, timeout):
+        end = time.perf_counter() + timeout
+        while not condition():
+            if time.perf_counter() > end:
+                return False
+            self.app.processEvents()
+            time.sleep(0.0002)
+        return True
+
+    def measure(self, kind, start, end):
+        if end is None:
+            self.skipped += 1
+        else:
+            self.latencies.setdefault(kind, []).append((end - start) * 1000.0)
+
+    def replay(self, events, directory):
+        self.directory = Path(directory)
+        start = time.perf_counter()
+        for event in events:
+            if self.realtime:
+                self.wait(lambda: time.perf_counter() - start >= event.get('t', 0), float('inf'))
+            handler = getattr(self, 'replay_' + event.get('type', ''), None)
+            if handler is not None:
+                handler(event)
+        self.editor.wait_for_save()
+        tasks.task_pool().waitForDone()
+        self.app.processEvents()
+
+    def first_tab_shown(self):
+        if not self.maps_changed:
+            return False
+        if not self.map_view.valid:
+            return True  # an error message
+        viewer = self.map_view.currentWidget()
+        return viewer is not None and viewer.image_label.pixmap() is not None
+
+    def wait_for_first_tab(self, kind, start):
+        if not self.wait(self.first_tab_shown, RENDER_TIMEOUT):
+            self.measure(kind, start, None)
+            return
+        viewer = self.map_view.currentWidget()
+        if self.map_view.valid and viewer is not None:
+            self.watcher.arm(viewer.image_label)
+            viewer.image_label.update()
+            self.wait(lambda: self.watcher.painted is not None, PAINT_TIMEOUT)
+        self.measure(kind, start, time.perf_counter())
+
+    def replay_open(self, event):
+        path = self.directory.joinpath(event.get('name') or 'untitled.ifm')
+        with open(str(path), 'w', encoding='utf-8') as file:
+            file.write(event.get('text', ''))
+        self.editor.editor_modified = False
+        self.maps_changed = False
+        start = time.perf_counter()
+        self.editor.open_path(path, check_modified=False)
+        self.wait_for_first_tab(session.EVENT_OPEN, start)
+
+    def replay_edit(self, event):
+        position, removed = event['position'], event['removed']
+        document = self.editor.document()
+        if position + removed >= document.characterCount():
+            self.skipped += 1  # the session doesn't match the document anymore
+            return
+        self.watcher.arm(self.editor.viewport())
+        start = time.perf_counter()
+        cursor = QTextCursor(document)
+        cursor.setPosition(position)
+        cursor.setPosition(position + removed, QTextCursor.KeepAnchor)
+        cursor.insertText(event.get('text', ''))
+        self.editor.setTextCursor(cursor)
+        self.wait(lambda: self.watcher.painted is not None, PAINT_TIMEOUT)
+        self.measure(session.EVENT_EDIT, start, self.watcher.painted)
+
+    def replay_save(self, event):
+        if self.editor.current_file is None:
+            return
+        self.maps_changed = False
+        start = time.perf_counter()
+        self.editor.save_file()
+        self.wait_for_first_tab(session.EVENT_SAVE, start)
+
+    def replay_tab(self, event):
+        index = event['index']
+        if not self.map_view.valid or index >= self.map_view.count() or index == self.map_view.currentIndex():
+            return
+        self.watcher.arm(self.map_view.widget(index).image_label)
+        start = time.perf_counter()
+        self.map_view.setCurrentIndex(index)
+        self.wait(lambda: self.watcher.painted is not None, PAINT_TIMEOUT)
+        self.measure(session.EVENT_TAB, start, self.watcher.painted)
+
+    def replay_zoom(self, event):
+        actions = {session.ZOOM_IN: self.main_window.zoom_in_action,
+                   session.ZOOM_OUT: self.main_window.zoom_out_action,
+                   session.ZOOM_NORMAL: self.main_window.normal_size_action}
+        action = actions.get(event.get('action'))
+        viewer = self.map_view.currentWidget()
+        if action is None or not action.isEnabled() or not self.map_view.valid or viewer is None:
+            return
+        self.watcher.arm(viewer.image_label)
+        start = time.perf_counter()
+        action.trigger()
+        self.wait(lambda: self.watcher.painted is not None, PAINT_TIMEOUT)
+        self.measure(session.EVENT_ZOOM, start, self.watcher.painted)
+
+    def report(self):
+        lines = ['{:<8} {:>6} '.format('', 'count') +
+                 ' '.join('{:>9}'.format('p' + str(p)) for p in PERCENTILES) + ' {:>9}'.format('max')]
+        for kind in sorted(self.latencies):
+            values = self.latencies[kind]
+            lines.append('{:<8} {:>6} '.format(kind, len(values)) +
+                         ' '.join('{:>9.1f}'.format(percentile(values, p)) for p in PERCENTILES) +
+                         ' {:>9.1f}'.format(max(values)))
+        if self.skipped > 0:
+            lines.append('{} interactions skipped or timed out'.format(self.skipped))
+        lines.append('(latencies in ms)')
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        result = {}
+        for kind, values in self.latencies.items():
+            entry = {'count': len(values), 'max': max(values)}
+            for p in PERCENTILES:
+                entry['p' + str(p)] = percentile(values, p)
+            result[kind] = entry
+        return result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Replays a recorded qtIFM session and reports its latencies')
+    parser.add_argument('session', type=Path, help='the session file, recorded with main.py --record')
+    parser.add_argument('--repeat', type=int, default=1, help='the number of times the session is replayed')
+    parser.add_argument('--realtime', action='store_true',
+                        help='keep the pauses between the interactions, as recorded')
+    parser.add_argument('--json', type=Path, metavar='FILE', help='write the percentiles to FILE as JSON')
+    args = parser.parse_args(argv[1:])
+
+    try:
+        events = session.load_session(args.session)
+    except (OSError, ValueError) as e:
+        sys.stderr.write('Could not read the session file: ' + str(e) + '\n')
+        return 1
+
+    with tempfile.TemporaryDirectory(prefix='qtifm-replay-') as directory:
+        home = Path(directory).joinpath('home')
+        home.mkdir()
+        os.environ['HOME'] = str(home)
+        os.environ['XDG_CACHE_HOME'] = str(home.joinpath('.cache'))
+        os.environ['XDG_RUNTIME_DIR'] = str(home)
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+        app = QApplication(argv[:1])
+        gui.Editor.recover_journals = False
+        main_window = gui.MainWindow()
+        main_window.config.map_prefetch_recent_files = False  # no renders besides the replayed ones
+        main_window.show()
+
+        replayer = SessionReplayer(app, main_window, args.realtime)
+        for i in range(0, max(1, args.repeat)):
+            run_directory = Path(directory).joinpath(str(i))
+            run_directory.mkdir()
+            replayer.replay(events, run_directory)
+        main_window.editor.journal.discard()
+        main_window.prefetcher.stop()
+
+    print(replayer.report())
+    if args.json is not None:
+        with open(str(args.json), 'w', encoding='utf-8') as file:
+            json.dump(replayer.to_dict(), file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Recording editing sessions as replayable scripts, see replay.py
+#
+# A session file has one JSON object per line: a header {"version": ...} followed by the events,
+# each with its time "t" in seconds since the start of the recording:
+#   {"type": "open", "name": ..., "text": ...}   a file was opened (or a new one started)
+#   {"type": "edit", "position": ..., "removed": ..., "text": ...}
+#   {"type": "save"}
+#   {"type": "tab", "index": ...}                 a map tab was selected
+#   {"type": "zoom", "action": "in" | "out" | "normal"}
+# Zooming with the mouse wheel isn't recorded.
+#
+
+import json
+import sys
+import time
+import traceback
+
+from PyQt5.QtCore import QObject
+
+SESSION_VERSION = 1
+
+EVENT_OPEN = 'open'
+EVENT_EDIT = 'edit'
+EVENT_SAVE = 'save'
+EVENT_TAB = 'tab'
+EVENT_ZOOM = 'zoom'
+
+ZOOM_IN = 'in'
+ZOOM_OUT = 'out'
+ZOOM_NORMAL = 'normal'
+
+
+class SessionRecorder(QObject):
+    # Writes the interactions with the main window to the session file as they happen, so the
+    # session survives a crash.
+
+    def __init__(self, main_window, path):
+        QObject.__init__(self, main_window)
+        self.main_window = main_window
+        self.editor = main_window.editor
+        self.start = time.monotonic()
+        self.file = open(str(path), 'w', encoding='utf-8')
+        self.file.write(json.dumps({'version': SESSION_VERSION}) + '\n')
+
+        self.editor.file_loaded_signal.connect(self.file_loaded)
+        self.editor.document().contentsChange.connect(self.contents_change)
+        main_window.save_action.triggered.connect(self.saved)
+        main_window.map_view.tabBarClicked.connect(self.tab_clicked)
+        main_window.zoom_in_action.triggered.connect(lambda: self.zoomed(ZOOM_IN))
+        main_window.zoom_out_action.triggered.connect(lambda: self.zoomed(ZOOM_OUT))
+        main_window.normal_size_action.triggered.connect(lambda: self.zoomed(ZOOM_NORMAL))
+        self.file_loaded()
+
+    def write(self, event):
+        if self.file is None:
+            return
+        event['t'] = round(time.monotonic() - self.start, 4)
+        try:
+            self.file.write(json.dumps(event) + '\n')
+            self.file.flush()
+        except OSError:
+            sys.stderr.write('Could not write the session file: \'' + self.file.name + '\'\n')
+            traceback.print_exc(file=sys.stderr)
+            self.close()
+
+    def file_loaded(self):
+        file = self.editor.current_file
+        self.write({'type': EVENT_OPEN, 'name': file.name if file is not None else None,
+                    'text': self.editor.toPlainText()})
+
+    def contents_change(self, position, removed, added):
+        if self.editor.editor_init:
+            return  # a file is loaded, recorded as a whole
+        self.write({'type': EVENT_EDIT, 'position': position, 'removed': removed,
+                    'text': self.editor.inserted_text(position, added)})
+
+    def saved(self):
+        if self.editor.current_file is not None:
+            self.write({'type': EVENT_SAVE})
+
+    def tab_clicked(self, index):
+        if index >= 0:
+            self.write({'type': EVENT_TAB, 'index': index})
+
+    def zoomed(self, action):
+        self.write({'type': EVENT_ZOOM, 'action': action})
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def load_session(path):
+    # returns the events of a session file
+    with open(str(path), 'r', encoding='utf-8') as file:
+        header = json.loads(file.readline())
+        if header.get('version') != SESSION_VERSION:
+            raise ValueError('Unsupported session version: ' + str(header.get('version')))
+        events = []
+        for line in file:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                break  # the last line may be incomplete after a crash
+    return events
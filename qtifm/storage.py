@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Saving files and the crash recovery journal
+#
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import traceback
+
+from config import cache_path
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# the open lock files of the journals owned by this process, by journal name
+journal_locks = {}
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def write_atomic(path, text):
+    # Writes the text to a temporary file in the same directory, syncs it to disk and renames it
+    # over the target, so the file either has the old or the new content, never a part of it.
+    # Returns the hash of the written text.
+    target = Path(os.path.realpath(str(path)))
+    fd, temp = tempfile.mkstemp(prefix='.' + target.name + '.', suffix='.tmp', dir=str(target.parent))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        try:
+            os.chmod(temp, os.stat(str(target)).st_mode & 0o7777)
+        except FileNotFoundError:
+            os.chmod(temp, 0o644)
+        os.replace(temp, str(target))
+    except BaseException:
+        try:
+            os.unlink(temp)
+        except OSError:
+            pass
+        raise
+
+    sync_directory(target.parent)
+    return text_hash(text)
+
+
+def sync_directory(directory):
+    # makes the rename durable, not supported by every platform and file system
+    try:
+        fd = os.open(str(directory), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def lock_journal(name):
+    # Only one instance owns the journal of a file or of untitled text, it recovers and removes the
+    # journal. The other instances editing the same file use a journal of their own, which isn't
+    # recovered. Returns True if this process owns the journal.
+    if fcntl is None or name in journal_locks:
+        return True
+    path = cache_path().joinpath('journal', name_hash(name) + '.lock')
+    lock = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        lock = open(str(path), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        journal_locks[name] = lock
+        return True
+    except OSError:
+        if lock is not None:
+            lock.close()
+        return False
+
+
+def unlock_journal(name):
+    lock = journal_locks.pop(name, None)
+    if lock is not None:
+        lock.close()
+
+
+def name_hash(name):
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+
+def journal_path(name):
+    return cache_path().joinpath('journal', name_hash(name) + '.journal')
+
+
+class RecoveryJournal:
+    # Records the edits since the last save as [position, removed, inserted text] operations. The
+    # journal file starts with a header line naming the file and the hash of the saved content the
+    # operations apply to, followed by one operation per line. Only appends happen while editing.
+
+    def __init__(self):
+        self.file = None
+        self.base = None
+        self.name = None
+        self.owned = None  # the name of the journal locked by this instance
+        self.ops = []
+        self.first = 0  # the number of the first operation in ops, the earlier ones are saved
+        self.flushed = 0
+        self.active = False
+
+    def start(self, file, base, recover=False):
+        # returns the operations of a journal left by an unclean exit if recover and this instance
+        # owns the journal, they apply to the content with the given hash
+        self.discard()
+        self.file = file
+        self.base = base
+        self.name = self.claim(file)
+        ops = find_journal(self.name, base) if recover and self.name == self.owned else None
+        remove_journal(self.name)
+        self.active = True
+        return ops
+
+    def claim(self, file):
+        # the name of the journal of the file, the shared name only if this instance owns it
+        name = str(file) if file is not None else 'untitled'
+        if self.owned != name:
+            if self.owned is not None:
+                unlock_journal(self.owned)
+            self.owned = name if lock_journal(name) else None
+        return name if self.owned == name else name + '-' + str(os.getpid())
+
+    def record(self, position, removed, text):
+        if self.active:
+            self.ops.append([position, removed, text])
+
+    def mark(self):
+        # the number of operations recorded so far, used to find the edits made during a save
+        return self.first + len(self.ops)
+
+    def saved(self, file, base, mark):
+        # the file was saved with the content up to mark, the later operations apply to the new base
+        if mark < self.first:
+            return  # a later save has finished already
+        remaining = self.ops[mark - self.first:]
+        self.discard()
+        self.file = file
+        self.base = base
+        self.name = self.claim(file)
+        self.active = True
+        self.ops = remaining
+        self.first = mark
+        self.flush()
+
+    def flush(self):
+        if not self.active or self.flushed == len(self.ops):
+            return
+        path = journal_path(self.name)
+        if self.flushed > 0 and not path.exists():
+            self.flushed = 0  # removed from outside, written again with the header
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(str(path), 'a', encoding='utf-8') as journal:
+                if self.flushed == 0:
+                    journal.write(json.dumps({'file': str(self.file) if self.file is not None else None,
+                                              'base': self.base}) + '\n')
+                for op in self.ops[self.flushed:]:
+                    journal.write(json.dumps(op) + '\n')
+            self.flushed = len(self.ops)
+        except OSError:
+            sys.stderr.write('Could not write the recovery journal: \'' + str(path) + '\'\n')
+            traceback.print_exc(file=sys.stderr)
+            self.active = False
+
+    def discard(self):
+        if self.active and self.flushed > 0:
+            try:
+                journal_path(self.name).unlink()
+            except OSError:
+                pass
+        self.ops = []
+        self.first = 0
+        self.flushed = 0
+        self.active = False
+
+
+def find_journal(name, base):
+    # returns the operations of a journal left by an unclean exit, if they apply to the given content
+    path = journal_path(name)
+    if not path.exists():
+        return None
+
+    ops = []
+    try:
+        with open(str(path), 'r', encoding='utf-8') as journal:
+            header = json.loads(journal.readline())
+            if not isinstance(header, dict) or header.get('base') != base:
+                return None
+            for line in journal:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    break  # the last line may be incomplete after a crash
+                if not valid_op(op):
+                    break
+                ops.append(op)
+    except (OSError, ValueError):
+        return None
+    return ops if len(ops) > 0 else None
+
+
+def valid_op(op):
+    return isinstance(op, list) and len(op) == 3 and isinstance(op[0], int) and isinstance(op[1], int) \
+        and isinstance(op[2], str)
+
+
+def remove_journal(name):
+    try:
+        journal_path(name).unlink()
+    except OSError:
+        pass
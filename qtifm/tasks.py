@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Running functions on a thread pool
+#
+
+import sys
+import traceback
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+# tasks are referenced here until they are finished, so python doesn't collect them while running
+running_tasks = set()
+# Qt uses the global pool itself, e.g. to scale images in parallel while painting, and the gui thread
+# waits for that holding the GIL. Python tasks waiting for the GIL in the global pool would deadlock.
+shared_pool = None
+
+
+def task_pool():
+    global shared_pool
+    if shared_pool is None:
+        shared_pool = QThreadPool()
+    return shared_pool
+
+
+class TaskSignals(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+
+class Task(QRunnable):
+
+    def __init__(self, function, *args):
+        QRunnable.__init__(self)
+        self.setAutoDelete(False)
+        self.function = function
+        self.args = args
+        self.signals = TaskSignals()
+        self.signals.finished.connect(self.done)
+        self.signals.failed.connect(self.done)
+
+    def run(self):
+        try:
+            result = self.function(*self.args)
+        except Exception:
+            error = traceback.format_exc()
+            sys.stderr.write(error)
+            self.signals.failed.emit(error)
+            return
+        self.signals.finished.emit(result)
+
+    def done(self):
+        running_tasks.discard(self)
+
+
+def start_task(function, *args, finished=None, failed=None, priority=0, pool=None):
+    # runs function(*args) on a worker thread, the callbacks are called on the gui thread
+    task = Task(function, *args)
+    if finished is not None:
+        task.signals.finished.connect(finished)
+    if failed is not None:
+        task.signals.failed.connect(failed)
+    running_tasks.add(task)
+    if pool is None:
+        pool = task_pool()
+    pool.start(task, priority)
+    return task
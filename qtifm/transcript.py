@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Importing game transcripts: the rooms and the movements between them are turned into IFM source.
+#
+# A transcript is read line by line from a memory mapped file. After a command (a line starting with
+# the prompt '>') that moves the player, the first line of output is taken as the name of the new
+# room if it looks like a room title: short, capitalized and not ending like a sentence. Rooms are
+# identified by their names. The IFM source is produced in chunks while reading, so only the rooms
+# and their connections are kept in memory, not the transcript or the output.
+#
+
+import functools
+import mmap
+import os
+import threading
+
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+
+PROMPT = '>'
+MAX_TITLE_LENGTH = 50
+MAX_TITLE_WORDS = 8
+PROGRESS_STEP = 1024 * 1024
+WINDOW = 16 * 1024 * 1024
+# chunks handed to the gui thread and not yet consumed, the reader waits when there are more
+MAX_PENDING_CHUNKS = 4
+
+DIRECTIONS = {
+    'n': 'n', 'north': 'n',
+    's': 's', 'south': 's',
+    'e': 'e', 'east': 'e',
+    'w': 'w', 'west': 'w',
+    'ne': 'ne', 'northeast': 'ne', 'north-east': 'ne',
+    'nw': 'nw', 'northwest': 'nw', 'north-west': 'nw',
+    'se': 'se', 'southeast': 'se', 'south-east': 'se',
+    'sw': 'sw', 'southwest': 'sw', 'south-west': 'sw',
+    'u': 'up', 'up': 'up', 'climb up': 'up',
+    'd': 'down', 'down': 'down', 'climb down': 'down',
+    'in': 'in', 'enter': 'in', 'inside': 'in',
+    'out': 'out', 'exit': 'out', 'outside': 'out', 'leave': 'out',
+}
+COMPASS = {'n', 's', 'e', 'w', 'ne', 'nw', 'se', 'sw'}
+LOOK_COMMANDS = {'l', 'look'}
+MOVE_VERBS = ('go ', 'walk ', 'run ')
+
+
+@functools.lru_cache(maxsize=1024)  # most commands of a transcript are repeated
+def command_direction(command):
+    # the direction of a movement command, 'look' for a look command, None for anything else
+    command = ' '.join(command.lower().split())
+    if command in LOOK_COMMANDS:
+        return 'look'
+    for verb in MOVE_VERBS:
+        if command.startswith(verb):
+            command = command[len(verb):]
+            break
+    return DIRECTIONS.get(command)
+
+
+def room_title(line):
+    # the room name if the line looks like a room title, otherwise None
+    if '(' in line and line.endswith(')'):
+        line = line[:line.index('(')].rstrip()  # e.g. "Kitchen (on the chair)"
+    if len(line) == 0 or len(line) > MAX_TITLE_LENGTH or len(line.split()) > MAX_TITLE_WORDS:
+        return None
+    if not line[0].isupper() or line[-1] in '.!?:;,"\'' or line.startswith(PROMPT):
+        return None
+    return line
+
+
+class TranscriptParser:
+    # Turns the lines of a transcript into IFM statements, see take_output()
+
+    def __init__(self):
+        self.rooms = {}  # name -> tag
+        self.connections = set()
+        self.current = None
+        self.direction = None
+        self.expect_title = False
+        self.output = []
+
+    def feed(self, line):
+        line = line.strip()
+        if line.startswith(PROMPT):
+            self.direction = command_direction(line[len(PROMPT):])
+            self.expect_title = self.direction is not None
+        elif self.expect_title and len(line) > 0:
+            self.expect_title = False
+            name = room_title(line)
+            if name is not None:
+                self.arrive(self.direction, name)
+
+    def arrive(self, direction, name):
+        tag = self.rooms.get(name)
+        if tag is not None and tag == self.current:
+            return  # the player didn't move
+
+        if self.current is None or direction == 'look':
+            if tag is None:
+                tag = self.add_room(name)
+        elif tag is None:
+            tag = self.add_room(name, direction, self.current)
+        elif frozenset((self.current, tag)) not in self.connections:
+            self.connections.add(frozenset((self.current, tag)))
+            if direction in COMPASS:
+                self.output.append('link {} to {};'.format(self.current, tag))
+            else:
+                self.output.append('join {} to {} go {};'.format(self.current, tag, direction))
+        self.current = tag
+
+    def add_room(self, name, direction=None, origin=None):
+        tag = 'R' + str(len(self.rooms) + 1)
+        self.rooms[name] = tag
+        text = 'room "{}" tag {}'.format(name.replace('"', '\''), tag)
+        if direction in COMPASS:
+            self.output.append('{} dir {} from {};'.format(text, direction, origin))
+        else:
+            # rooms reached by up, down, in or out start a new map section
+            self.output.append(text + ';')
+            if origin is not None:
+                self.output.append('join {} to {} go {};'.format(origin, tag, direction))
+        if origin is not None:
+            self.connections.add(frozenset((origin, tag)))
+        return tag
+
+    def take_output(self):
+        text = ''.join(line + '\n' for line in self.output)
+        self.output = []
+        return text
+
+
+def scan_transcript(filename, parser):
+    # Feeds the parser the lines it needs: the command lines and, after a movement, the lines up to
+    # the first one with text. The other lines are skipped by searching the next prompt. Yields the
+    # position now and then. The pages read are released from the mapping every WINDOW bytes, so
+    # the memory use doesn't grow with the size of the transcript.
+    with open(str(filename), 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if hasattr(data, 'madvise'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            position = 0
+            reported = 0
+            released = 0
+            while position < size:
+                if not parser.expect_title and data[position:position + 1] != b'>':
+                    found = data.find(b'\n>', position)
+                    if found < 0:
+                        break
+                    position = found + 1
+                end = data.find(b'\n', position)
+                if end < 0:
+                    end = size
+                parser.feed(data[position:end].decode('utf-8', errors='replace'))
+                position = end + 1
+
+                if position - reported >= PROGRESS_STEP:
+                    reported = position
+                    yield position
+                if position - released >= WINDOW and hasattr(data, 'madvise'):
+                    start = released - released % mmap.PAGESIZE
+                    data.madvise(mmap.MADV_DONTNEED, start, position - position % mmap.PAGESIZE - start)
+                    released = position
+    yield size
+
+
+def import_transcript(filename, title=None, cancelled=None):
+    # Yields (IFM source chunk, percent read) while reading the transcript. A chunk may be empty.
+    parser = TranscriptParser()
+    if title is not None:
+        parser.output.append('title "{}";'.format(title.replace('"', '\'')))
+        parser.output.append('')
+    size = max(1, os.stat(str(filename)).st_size)
+    for position in scan_transcript(filename, parser):
+        if cancelled is not None and cancelled():
+            return
+        yield parser.take_output(), min(100, int(position * 100 / size))
+    yield parser.take_output(), 100
+
+
+class ImportSignals(QObject):
+    chunk = pyqtSignal(str)
+    progress = pyqtSignal(int)
+    finished = pyqtSignal(str)  # the error message, empty on success
+
+
+class ImportJob(QRunnable):
+    # Imports a transcript on a worker thread. The gui thread has to call chunk_done() for every
+    # chunk it received, so the reader never gets more than MAX_PENDING_CHUNKS ahead.
+
+    def __init__(self, filename, title=None):
+        QRunnable.__init__(self)
+        self.setAutoDelete(False)
+        self.filename = filename
+        self.title = title
+        self.signals = ImportSignals()
+        self.cancelled = False
+        self.pending = threading.Semaphore(MAX_PENDING_CHUNKS)
+
+    def cancel(self):
+        self.cancelled = True
+        self.pending.release()
+
+    def chunk_done(self):
+        self.pending.release()
+
+    def run(self):
+        try:
+            for text, percent in import_transcript(self.filename, self.title, lambda: self.cancelled):
+                if len(text) > 0:
+                    while not self.pending.acquire(timeout=0.1):
+                        if self.cancelled:
+                            break
+                    if self.cancelled:
+                        break
+                    self.signals.chunk.emit(text)
+                self.signals.progress.emit(percent)
+        except (OSError, ValueError) as e:
+            self.signals.finished.emit(str(e))
+            return
+        self.signals.finished.emit('')
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# The stall watchdog: logs the stack of the gui thread whenever the event loop is blocked too long
+#
+
+import logging
+import logging.handlers
+import sys
+import threading
+import time
+import traceback
+
+from config import cache_path
+from PyQt5.QtCore import QObject, QTimer
+
+# upper bounds of the histogram buckets in ms, the last bucket is open
+HISTOGRAM_BUCKETS = [250, 500, 1000, 2000, 5000]
+LOG_SIZE = 1024 * 1024
+LOG_BACKUPS = 3
+RECENT_STALLS = 20
+
+
+def stall_log_path():
+    return cache_path().joinpath('stalls.log')
+
+
+class Stall:
+
+    def __init__(self, duration, stack):
+        self.duration = duration
+        self.stack = stack
+        self.time = time.time()
+
+
+class StallWatchdog(QObject):
+    # A timer on the gui thread updates a heartbeat. A watchdog thread checks the heartbeat; once it's
+    # older than the threshold, the current stack of the gui thread is taken. The stall is logged with
+    # its duration when the heartbeat comes back.
+
+    def __init__(self, threshold, parent=None):
+        QObject.__init__(self, parent)
+        self.threshold = threshold / 1000.0
+        self.interval = self.threshold / 4
+        self.main_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.histogram = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.recent = []
+
+        self.logger = logging.getLogger('qtifm.stalls')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = None
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(max(1, int(self.interval * 1000)))
+        self.timer.timeout.connect(self.beat)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        try:
+            stall_log_path().parent.mkdir(parents=True, exist_ok=True)
+            self.handler = logging.handlers.RotatingFileHandler(str(stall_log_path()), maxBytes=LOG_SIZE,
+                                                                backupCount=LOG_BACKUPS, encoding='utf-8')
+            self.handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self.logger.addHandler(self.handler)
+        except OSError:
+            sys.stderr.write('Could not open the stall log: \'' + str(stall_log_path()) + '\'\n')
+            traceback.print_exc(file=sys.stderr)
+
+        self.last_beat = time.monotonic()
+        self.stop_event.clear()
+        self.timer.start()
+        self.thread = threading.Thread(target=self.watch, name='qtifm-watchdog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.timer.stop()
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        if self.handler is not None:
+            self.logger.removeHandler(self.handler)
+            self.handler.close()
+            self.handler = None
+
+    def beat(self):
+        self.last_beat = time.monotonic()
+
+    def watch(self):
+        stalled_since = None
+        stack = None
+        while not self.stop_event.wait(self.interval):
+            beat = self.last_beat
+            if stalled_since is None:
+                if time.monotonic() - beat > self.threshold:
+                    stalled_since = beat
+                    frame = sys._current_frames().get(self.main_thread)
+                    stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            elif beat != stalled_since:
+                self.record(Stall(beat - stalled_since, stack))
+                stalled_since = None
+                stack = None
+
+    def record(self, stall):
+        milliseconds = int(stall.duration * 1000)
+        with self.lock:
+            self.histogram[self.bucket(milliseconds)] += 1
+            self.recent.append(stall)
+            del self.recent[:-RECENT_STALLS]
+        self.logger.info('GUI thread blocked for %d ms\n%s', milliseconds, stall.stack)
+
+    @staticmethod
+    def bucket(milliseconds):
+        for i, limit in enumerate(HISTOGRAM_BUCKETS):
+            if milliseconds < limit:
+                return i
+        return len(HISTOGRAM_BUCKETS)
+
+    def summary(self):
+        with self.lock:
+            histogram = list(self.histogram)
+            recent = list(self.recent)
+
+        lines = []
+        lower = int(self.threshold * 1000)
+        width = max(histogram + [1])
+        for i, count in enumerate(histogram):
+            if i < len(HISTOGRAM_BUCKETS):
+                label = '{:>5} - {:>5} ms'.format(lower, HISTOGRAM_BUCKETS[i])
+                lower = HISTOGRAM_BUCKETS[i]
+            else:
+                label = '{:>5} ms -      '.format(lower)
+            lines.append('{} {:>5}  {}'.format(label, count, '#' * int(40 * count / width)))
+
+        for stall in reversed(recent):
+            lines.append('')
+            lines.append(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stall.time)) +
+                         '  {} ms'.format(int(stall.duration * 1000)))
+            lines.append(stall.stack.rstrip('\n'))
+        return '\n'.join(lines)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# The room and link geometry read from a fig file with polyline and spline links
+#
+
+import sys
+import unittest
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath('qtifm')))
+
+import mapindex
+
+FIXTURES = Path(__file__).resolve().parent.joinpath('fixtures')
+
+
+class MapGeometryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fig = mapindex.parse_fig(FIXTURES.joinpath('links.fig'))
+        self.geometry = mapindex.MapGeometry(self.fig, 1.0)
+
+    def test_rooms(self):
+        self.assertEqual(1200, self.fig.resolution)
+        self.assertEqual(['Kitchen', 'Hall', 'Cellar'], [room.name for room in self.geometry.rooms])
+
+    def test_links(self):
+        # the polyline, and the spline after an arc with an arrow
+        self.assertEqual([[(1800, 1800), (1800, 3600)], [(2400, 1500), (3000, 1300), (3600, 1500)]],
+                         self.fig.polylines)
+        links = [(link.from_room.name, link.to_room.name) for link in self.geometry.links]
+        self.assertEqual([('Kitchen', 'Cellar'), ('Kitchen', 'Hall')], links)
+
+    def test_link_selects_target_room(self):
+        self.geometry.set_image_size(self.geometry.bbox.width() * self.geometry.scale,
+                                     self.geometry.bbox.height() * self.geometry.scale)
+        for x, y, name in ((1800, 2700, 'Cellar'), (3000, 1300, 'Hall')):
+            room = self.geometry.hit_test(*self.geometry.to_image(x, y))
+            self.assertEqual(name, room.name if room is not None else None)
+
+
+if __name__ == '__main__':
+    unittest.main()